@@ -1,7 +1,13 @@
+import json
+import subprocess
+import sys
+import time
+
 import numpy as np
+import torch
 from sklearn.decomposition import PCA
 
-from scvi.dataset import CortexDataset
+from scvi.dataset import CortexDataset, SparseSyntheticDatasetCorr
 from scvi.inference import UnsupervisedTrainer, TrainerFish
 from scvi.inference.annotation import compute_accuracy_nn
 from scvi.inference.posterior import proximity_imputation
@@ -44,6 +50,109 @@ def benchmark(dataset, n_epochs=250, use_cuda=True):
     return trainer
 
 
+def mixed_precision_benchmark(dataset, n_epochs=50, use_cuda=False, seed=0):
+    """
+    Trains the same VAE in float32 and under bfloat16 autocast, and compares their training times and the
+    test set ELBOs, both evaluated in float32.
+    :return: a dict with the ``speedup`` of mixed precision and the ELBOs of both runs
+    """
+    results = {}
+    for name, mixed_precision in [("float32", False), ("bfloat16", True)]:
+        torch.manual_seed(seed)
+        vae = VAE(dataset.nb_genes, n_batch=dataset.n_batches)
+        trainer = UnsupervisedTrainer(
+            vae,
+            dataset,
+            train_size=0.9,
+            use_cuda=use_cuda,
+            mixed_precision=mixed_precision,
+            show_progbar=False,
+        )
+        trainer.train(n_epochs=n_epochs)
+        results["time_" + name] = trainer.training_time
+        results["elbo_" + name] = trainer.test_set.elbo()
+    results["speedup"] = results["time_float32"] / results["time_bfloat16"]
+    results["elbo_relative_gap"] = (
+        abs(results["elbo_bfloat16"] - results["elbo_float32"])
+        / results["elbo_float32"]
+    )
+    return results
+
+
+def mixed_precision_benchmarks(
+    n_epochs=50, use_cuda=False, save_path="data/", n_cells_cluster=100000
+):
+    return {
+        "cortex": mixed_precision_benchmark(
+            CortexDataset(save_path=save_path), n_epochs=n_epochs, use_cuda=use_cuda
+        ),
+        "synthetic": mixed_precision_benchmark(
+            SparseSyntheticDatasetCorr(n_cells_cluster=n_cells_cluster),
+            n_epochs=n_epochs,
+            use_cuda=use_cuda,
+        ),
+    }
+
+
+def fast_training_benchmark(
+    dataset, n_epochs=250, use_cuda=False, seed=0, lr_schedule="one_cycle"
+):
+    """
+    Trains the same VAE for ``n_epochs`` at a constant learning rate, then at the learning rate suggested by
+    ``lr_range_test`` with ``lr_schedule``, stopping as soon as it reaches the test set ELBO of the first run.
+    :return: a dict with the training times, the numbers of epochs and the test set ELBOs of both runs, and the
+        learning rate and stop reason of the second one, whose training time includes the range test
+    """
+    results = {}
+    for name in ["constant", "scheduled"]:
+        torch.manual_seed(seed)
+        vae = VAE(dataset.nb_genes, n_batch=dataset.n_batches)
+        trainer = UnsupervisedTrainer(
+            vae,
+            dataset,
+            train_size=0.9,
+            use_cuda=use_cuda,
+            frequency=1 if name == "scheduled" else None,
+            lr_schedule=lr_schedule if name == "scheduled" else None,
+            show_progbar=False,
+        )
+        range_test_time = 0
+        if name == "constant":
+            trainer.train(n_epochs=n_epochs)
+        else:
+            begin = time.time()
+            _, _, lr = trainer.lr_range_test()
+            range_test_time = time.time() - begin
+            trainer.train(
+                n_epochs=n_epochs,
+                lr=lr,
+                target_metric="elbo",
+                target_value=results["elbo_constant"],
+            )
+            results["lr"] = lr
+            results["stop_reason"] = trainer.stop_reason
+        results["time_" + name] = trainer.training_time + range_test_time
+        results["epochs_" + name] = trainer.epoch + 1
+        results["elbo_" + name] = trainer.test_set.elbo()
+    results["speedup"] = results["time_constant"] / results["time_scheduled"]
+    return results
+
+
+def fast_training_benchmarks(
+    n_epochs=250, use_cuda=False, save_path="data/", n_cells_cluster=100000
+):
+    return {
+        "cortex": fast_training_benchmark(
+            CortexDataset(save_path=save_path), n_epochs=n_epochs, use_cuda=use_cuda
+        ),
+        "synthetic": fast_training_benchmark(
+            SparseSyntheticDatasetCorr(n_cells_cluster=n_cells_cluster),
+            n_epochs=n_epochs,
+            use_cuda=use_cuda,
+        ),
+    }
+
+
 def harmonization_benchmarks(n_epochs=1, use_cuda=True, save_path="data/"):
     # retina_benchmark(n_epochs=n_epochs)
     pass
@@ -122,3 +231,37 @@ def benchmark_fish_scrna(gene_dataset_seq, gene_dataset_fish):
     _, _, = compute_accuracy_nn(
         pca_latent_seq, pca_labels_seq.ravel(), pca_latent_fish, pca_labels_fish.ravel()
     )
+
+
+HEAVY_MODULES = [
+    "matplotlib",
+    "pandas",
+    "sklearn",
+    "scipy.stats",
+    "hyperopt",
+    "anndata",
+    "loompy",
+    "h5py",
+]
+
+
+def import_time_benchmark(module="scvi.inference", n_runs=3):
+    """
+    Measures the import time of ``module`` in fresh interpreters, and which heavy modules it loads.
+    :return: the best import time over ``n_runs`` runs in seconds, and the list of loaded heavy modules
+    """
+    code = (
+        "import json, sys, time\n"
+        "begin = time.perf_counter()\n"
+        "import {module}\n"
+        "elapsed = time.perf_counter() - begin\n"
+        "print(json.dumps([elapsed, [m for m in {heavy} if m in sys.modules]]))\n"
+    ).format(module=module, heavy=HEAVY_MODULES)
+    times = []
+    for _ in range(n_runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code], stdout=subprocess.PIPE, check=True
+        ).stdout
+        elapsed, loaded = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(elapsed)
+    return min(times), loaded
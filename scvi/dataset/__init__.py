@@ -1,21 +1,45 @@
-from .brain_large import BrainLargeDataset
-from .cortex import CortexDataset
+import importlib
+
 from .dataset import GeneExpressionDataset
-from .synthetic import (
-    SyntheticDataset,
-    SyntheticRandomDataset,
-    SyntheticDatasetCorr,
-    ZISyntheticDatasetCorr,
-)
-from .cite_seq import CiteSeqDataset, CbmcDataset
-from .pbmc import PbmcDataset, PurifiedPBMCDataset
-from .hemato import HematoDataset
-from .loom import LoomDataset, RetinaDataset
-from .dataset10X import Dataset10X, BrainSmallDataset
-from .anndata import AnnDataset
-from .csv import CsvDataset, BreastCancerDataset, MouseOBDataset
-from .seqfish import SeqfishDataset
-from .smfish import SmfishDataset
+
+# loaders, and the optional backends they rely on (loompy, anndata, h5py, pandas...), are imported on first access
+_lazy_imports = {
+    "BrainLargeDataset": ".brain_large",
+    "CortexDataset": ".cortex",
+    "SyntheticDataset": ".synthetic",
+    "SyntheticRandomDataset": ".synthetic",
+    "SyntheticDatasetCorr": ".synthetic",
+    "ZISyntheticDatasetCorr": ".synthetic",
+    "SparseSyntheticDatasetCorr": ".synthetic",
+    "CiteSeqDataset": ".cite_seq",
+    "CbmcDataset": ".cite_seq",
+    "PbmcDataset": ".pbmc",
+    "PurifiedPBMCDataset": ".pbmc",
+    "HematoDataset": ".hemato",
+    "LoomDataset": ".loom",
+    "RetinaDataset": ".loom",
+    "Dataset10X": ".dataset10X",
+    "BrainSmallDataset": ".dataset10X",
+    "AnnDataset": ".anndata",
+    "CsvDataset": ".csv",
+    "BreastCancerDataset": ".csv",
+    "MouseOBDataset": ".csv",
+    "SeqfishDataset": ".seqfish",
+    "SmfishDataset": ".smfish",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_imports))
+
 
 __all__ = [
     "SyntheticDataset",
@@ -40,4 +64,5 @@ __all__ = [
     "PurifiedPBMCDataset",
     "SyntheticDatasetCorr",
     "ZISyntheticDatasetCorr",
+    "SparseSyntheticDatasetCorr",
 ]
@@ -1,8 +1,19 @@
-from .dataset import GeneExpressionDataset
-import pandas as pd
-import numpy as np
-import os
+import bz2
+import gzip
+import io
+import itertools
 import logging
+import lzma
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp_sparse
+
+from .dataset import GeneExpressionDataset
 
 
 class CsvDataset(GeneExpressionDataset):
@@ -21,6 +32,9 @@ class CsvDataset(GeneExpressionDataset):
         :batch_ids_file: Name of the `.csv` file with batch indices.
             File contains two columns. The first holds cell names and second
             holds batch indices - type int. The first row of the file is header.
+        :dense: Whether to load as dense or sparse. Default: ``True``.
+        :chunksize: Number of rows of the file parsed at once. Default: ``1000``.
+        :n_jobs: Number of processes used to parse chunks in parallel. Default: ``1``.
 
     Examples:
         >>> # Loading a remote dataset
@@ -46,6 +60,9 @@ class CsvDataset(GeneExpressionDataset):
         gene_by_cell=True,
         labels_file=None,
         batch_ids_file=None,
+        dense=True,
+        chunksize=1000,
+        n_jobs=1,
     ):
         self.download_name = filename  # The given csv file is
         self.save_path = save_path
@@ -57,8 +74,12 @@ class CsvDataset(GeneExpressionDataset):
         )  # Whether the original dataset is genes by cells
         self.labels_file = labels_file
         self.batch_ids_file = batch_ids_file
+        self.chunksize = chunksize
+        self.n_jobs = n_jobs
 
         data, gene_names, labels, cell_types, batch_ids = self.download_and_preprocess()
+        if dense:
+            data = data.A
 
         super().__init__(
             *GeneExpressionDataset.get_attributes_from_matrix(
@@ -75,22 +96,15 @@ class CsvDataset(GeneExpressionDataset):
     def preprocess(self):
         logging.info("Preprocessing dataset")
 
-        if self.gene_by_cell:
-            data = pd.read_csv(
-                os.path.join(self.save_path, self.download_name),
-                sep=self.sep,
-                index_col=0,
-                compression=self.compression,
-            ).T
-        else:
-            data = pd.read_csv(
-                os.path.join(self.save_path, self.download_name),
-                sep=self.sep,
-                index_col=0,
-                compression=self.compression,
-            )
+        data, gene_names = read_sparse_csv(
+            os.path.join(self.save_path, self.download_name),
+            sep=self.sep,
+            compression=self.compression,
+            gene_by_cell=self.gene_by_cell,
+            chunksize=self.chunksize,
+            n_jobs=self.n_jobs,
+        )
 
-        gene_names = np.array(data.columns, dtype=str)
         labels, cell_types, batch_ids = None, None, None
         if self.labels_file is not None:
             labels = pd.read_csv(
@@ -105,7 +119,6 @@ class CsvDataset(GeneExpressionDataset):
             )
             batch_ids = batch_ids.values
 
-        data = data.values
         logging.info("Finished preprocessing dataset")
         return data, gene_names, labels, cell_types, batch_ids
 
@@ -132,3 +145,124 @@ class MouseOBDataset(CsvDataset):
             sep="\t",
             gene_by_cell=False,
         )
+
+
+def read_sparse_csv(
+    path,
+    sep=",",
+    compression=None,
+    gene_by_cell=True,
+    chunksize=1000,
+    n_jobs=1,
+    dtype=np.float32,
+):
+    """
+    Reads a delimited count table into a cells x genes CSR matrix, one chunk of rows at a time.
+    Each chunk is parsed with explicit dtypes and converted to CSR right away, so that no dense copy of
+    the whole table is ever held in memory. Chunks are cut between records, so quoted fields, e.g. row names,
+    may contain newlines.
+    :param path: path of the file, whose first row holds column names and first column holds row names
+    :param sep: delimiter
+    :param compression: one of ``None``, ``'infer'``, ``'gzip'``, ``'bz2'``, ``'zip'`` or ``'xz'``
+    :param gene_by_cell: whether rows of the file are genes (and columns cells)
+    :param chunksize: number of rows parsed at once
+    :param n_jobs: number of processes used to parse chunks, chunks are parsed in the main process if 1
+    :param dtype: dtype of the values
+    :return: the cells x genes ``csr_matrix`` and the gene names
+    """
+    with _open_text(path, compression) as f:
+        records = _iter_records(f)
+        header = _split_line(next(records, ""), sep)
+        first_line = next(records, "")
+        n_values = len(_split_line(first_line, sep)) - 1
+        # header may or may not name the index column
+        column_names = header[-n_values:] if n_values else np.array([], dtype=str)
+        chunks = _iter_chunks(itertools.chain([first_line], records), chunksize)
+
+        row_names, matrices = [], []
+        if n_jobs > 1:
+            with ProcessPoolExecutor(n_jobs) as executor:
+                # bounds the number of raw chunks held in memory
+                pending = deque()
+                for lines in itertools.chain(chunks, [None]):
+                    if lines is not None:
+                        pending.append(
+                            executor.submit(
+                                _parse_csv_chunk, lines, sep, n_values, dtype
+                            )
+                        )
+                    while pending and (lines is None or len(pending) >= 2 * n_jobs):
+                        names, matrix = pending.popleft().result()
+                        row_names += [names]
+                        matrices += [matrix]
+        else:
+            for lines in chunks:
+                names, matrix = _parse_csv_chunk(lines, sep, n_values, dtype)
+                row_names += [names]
+                matrices += [matrix]
+
+    data = sp_sparse.vstack(matrices, format="csr", dtype=dtype)
+    row_names = np.concatenate(row_names)
+    if gene_by_cell:
+        return data.T.tocsr(), row_names
+    return data, column_names
+
+
+def _parse_csv_chunk(lines, sep, n_values, dtype):
+    dtypes = {i: dtype for i in range(1, n_values + 1)}
+    dtypes[0] = str
+    chunk = pd.read_csv(
+        io.StringIO("".join(lines)),
+        sep=sep,
+        header=None,
+        index_col=0,
+        dtype=dtypes,
+        engine="c",
+    )
+    return np.array(chunk.index, dtype=str), sp_sparse.csr_matrix(chunk.values)
+
+
+def _split_line(line, sep):
+    return pd.read_csv(
+        io.StringIO(line), sep=sep, header=None, dtype=str, keep_default_na=False
+    ).values[0]
+
+
+def _iter_records(lines):
+    # a record goes on over the next line while its quotes are unbalanced, i.e. a quoted field holds a newline
+    record, n_quotes = [], 0
+    for line in lines:
+        record.append(line)
+        n_quotes += line.count('"')
+        if n_quotes % 2 == 0:
+            yield record[0] if len(record) == 1 else "".join(record)
+            record, n_quotes = [], 0
+    if record:
+        yield "".join(record)
+
+
+def _iter_chunks(lines, chunksize):
+    while True:
+        chunk = list(itertools.islice(lines, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _open_text(path, compression):
+    if compression == "infer":
+        extensions = {".gz": "gzip", ".bz2": "bz2", ".zip": "zip", ".xz": "xz"}
+        compression = extensions.get(os.path.splitext(path)[1])
+    if compression == "gzip":
+        return gzip.open(path, "rt")
+    if compression == "bz2":
+        return bz2.open(path, "rt")
+    if compression == "xz":
+        return lzma.open(path, "rt")
+    if compression == "zip":
+        archive = zipfile.ZipFile(path)
+        names = archive.namelist()
+        if len(names) != 1:
+            raise ValueError("ZIP file %s must contain only one data file" % path)
+        return io.TextIOWrapper(archive.open(names[0]))
+    return open(path)
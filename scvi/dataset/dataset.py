@@ -3,16 +3,20 @@
 """Handling datasets.
 For the moment, is initialized with a torch Tensor of size (n_cells, nb_genes)"""
 import copy
+import hashlib
 import os
 import logging
-import urllib.request
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import scipy.sparse as sp_sparse
 import torch
-from sklearn.preprocessing import StandardScaler
 from torch.utils.data import Dataset
 
+from scvi.dataset.spatial import SpatialGrid
+
 
 class GeneExpressionDataset(Dataset):
     """Gene Expression dataset. It deals with:
@@ -44,6 +48,7 @@ class GeneExpressionDataset(Dataset):
         self.batch_indices, self.n_batches = arrange_categories(batch_indices)
         self.labels, self.n_labels = arrange_categories(labels)
         self.x_coord, self.y_coord = x_coord, y_coord
+        self._spatial_index = None
         self.norm_X = None
         self.corrupted_X = None
 
@@ -66,6 +71,20 @@ class GeneExpressionDataset(Dataset):
         self._X = X
         self.library_size_batch()
 
+    @property
+    def spatial_index(self):
+        if self._spatial_index is None:
+            self.build_spatial_index()
+        return self._spatial_index
+
+    def build_spatial_index(self, cell_size=None):
+        if self.x_coord is None or self.y_coord is None:
+            raise ValueError("The dataset has no spatial coordinates to index")
+        self._spatial_index = SpatialGrid(
+            self.x_coord, self.y_coord, cell_size=cell_size
+        )
+        return self._spatial_index
+
     def __len__(self):
         return self.X.shape[0]
 
@@ -146,6 +165,7 @@ class GeneExpressionDataset(Dataset):
         logging.info("Downsampling from %i to %i genes" % (self.nb_genes, new_n_genes))
         if hasattr(self, "gene_names"):
             self.gene_names = self.gene_names[subset_genes]
+            self._gene_index = None
         if hasattr(self, "gene_symbols"):
             self.gene_symbols = self.gene_symbols[subset_genes]
         self._X = self.X[:, subset_genes]
@@ -184,13 +204,258 @@ class GeneExpressionDataset(Dataset):
         ]:
             if getattr(self, attr_name) is not None:
                 setattr(self, attr_name, getattr(self, attr_name)[subset_cells])
+        self._spatial_index = None
         self.library_size_batch()
 
+    def append_cells(
+        self,
+        X,
+        gene_names=None,
+        batch_indices=0,
+        labels=None,
+        new_batches=True,
+        x_coord=None,
+        y_coord=None,
+    ):
+        """
+        Appends new cells to the dataset in place, without copying the existing cells (the storage of the
+        expression matrix and of the per-cell arrays grows geometrically) or recomputing the library size
+        statistics of untouched batches.
+
+        :param X: expression matrix (dense or sparse) of the new cells
+        :param gene_names: gene names of the columns of ``X``, aligned on the dataset's ``gene_names``.
+            Missing genes are filled with zeros and extra genes are dropped. If ``None``, the columns of ``X``
+            must already match the dataset's genes.
+        :param batch_indices: batch of the new cells, an int or an array
+        :param labels: labels of the new cells, in the dataset's labels space. Default: ``None`` (all zeros).
+        :param new_batches: if True, ``batch_indices`` are relabelled as new batches following the existing ones,
+            otherwise they refer to existing batches
+        :param x_coord: x coordinates of the new cells, required if the dataset has coordinates
+        :param y_coord: y coordinates of the new cells, required if the dataset has coordinates
+        """
+        if gene_names is not None:
+            X = self._align_genes(X, gene_names)
+        elif X.shape[1] != self.nb_genes:
+            raise ValueError(
+                "Expected %d genes, got %d: specify gene_names to align them"
+                % (self.nb_genes, X.shape[1])
+            )
+        has_coords = self.x_coord is not None and self.y_coord is not None
+        if has_coords and (x_coord is None or y_coord is None):
+            raise ValueError(
+                "The dataset has spatial coordinates: x_coord and y_coord are required"
+            )
+
+        n_cells = X.shape[0]
+        batch_indices = (
+            np.full(n_cells, batch_indices, dtype=np.int64)
+            if np.isscalar(batch_indices)
+            else np.asarray(batch_indices).ravel()
+        )
+        if new_batches:
+            batch_indices = (
+                arrange_categories(batch_indices)[0].ravel() + self.n_batches
+            )
+        labels = (
+            np.zeros(n_cells, dtype=np.int64)
+            if labels is None
+            else np.asarray(labels).ravel()
+        )
+        if hasattr(self, "cell_types") and labels.max(initial=0) >= self.n_labels:
+            raise ValueError("Labels of new cells should refer to existing cell types")
+
+        ne_cells = np.asarray(X.sum(axis=1)).ravel() > 0
+        if not ne_cells.all():
+            logging.info(
+                "%d appended cells with zero expression in all genes considered were removed"
+                % (~ne_cells).sum()
+            )
+            X, batch_indices, labels = (
+                X[ne_cells],
+                batch_indices[ne_cells],
+                labels[ne_cells],
+            )
+            if has_coords:
+                x_coord = np.asarray(x_coord)[ne_cells]
+                y_coord = np.asarray(y_coord)[ne_cells]
+
+        n_old, n_new = len(self), X.shape[0]
+        library_statistics = self._library_statistics()
+        log_counts = np.log(np.asarray(X.sum(axis=1), dtype=np.float64).ravel())
+        self._X = self._grow_X(X)
+        self._grow_rows("batch_indices", batch_indices)
+        self._grow_rows("labels", labels)
+        self._grow_rows("local_means", np.zeros(n_new))
+        self._grow_rows("local_vars", np.zeros(n_new))
+        self.n_batches = max(self.n_batches, int(batch_indices.max(initial=-1)) + 1)
+        self.n_labels = max(self.n_labels, int(labels.max(initial=-1)) + 1)
+        if has_coords:
+            self._grow_rows("x_coord", np.asarray(x_coord))
+            self._grow_rows("y_coord", np.asarray(y_coord))
+        self.norm_X = None
+        self.corrupted_X = None
+        self._spatial_index = None
+
+        new_rows = np.arange(n_old, n_old + n_new)
+        for i_batch in np.unique(batch_indices):
+            in_batch = batch_indices == i_batch
+            self._update_library_size(
+                library_statistics,
+                int(i_batch),
+                new_rows[in_batch],
+                log_counts[in_batch],
+            )
+        self._library_stats = (self.batch_indices, library_statistics)
+
+    def _library_statistics(self):
+        # for each batch: its number of cells, the mean and variance of their log-library sizes and the chunks
+        # of their rows, computed once and then kept up to date by append_cells
+        cached = getattr(self, "_library_stats", None)
+        if cached is not None and cached[0] is self.batch_indices:
+            return cached[1]
+        batch_indices = np.asarray(self.batch_indices).ravel()
+        order = np.argsort(batch_indices, kind="stable")
+        batches, starts, counts = np.unique(
+            batch_indices[order], return_index=True, return_counts=True
+        )
+        library_statistics = {}
+        for i_batch, start, count in zip(batches, starts, counts):
+            rows = order[start : start + count]
+            library_statistics[int(i_batch)] = (
+                int(count),
+                np.float64(self.local_means[rows[0], 0]),
+                np.float64(self.local_vars[rows[0], 0]),
+                [rows],
+            )
+        return library_statistics
+
+    def _update_library_size(self, library_statistics, i_batch, rows, new_log_counts):
+        # merges the log-library statistics of the existing cells of the batch with those of the new cells:
+        # the rows of the other cells of the batch are only rewritten if it already had some
+        n_prev, mean_prev, var_prev, chunks = library_statistics.get(
+            i_batch, (0, 0.0, 0.0, [])
+        )
+        n_new = len(rows)
+        mean_new, var_new = np.mean(new_log_counts), np.var(new_log_counts)
+        if n_prev:
+            mean = (n_prev * mean_prev + n_new * mean_new) / (n_prev + n_new)
+            var = (
+                n_prev * (var_prev + (mean_prev - mean) ** 2)
+                + n_new * (var_new + (mean_new - mean) ** 2)
+            ) / (n_prev + n_new)
+        else:
+            mean, var = mean_new, var_new
+        chunks = chunks + [rows]
+        library_statistics[i_batch] = (n_prev + n_new, mean, var, chunks)
+        for chunk in chunks:
+            self.local_means[chunk] = mean
+            self.local_vars[chunk] = var
+
+    def _grow_rows(self, name, rows):
+        # like _grow_X for a per-cell array: the attribute is a view on the first rows of a buffer whose
+        # capacity doubles when exceeded
+        current = getattr(self, name)
+        n_old, n_new = len(current), len(rows)
+        row_buffers = getattr(self, "_row_buffers", None)
+        if row_buffers is None:
+            row_buffers = self._row_buffers = {}
+        buffer, grown = row_buffers.get(name, (None, None))
+        if grown is not current or len(buffer) < n_old + n_new:
+            capacity = max(2 * n_old, n_old + n_new)
+            buffer = np.empty((capacity,) + current.shape[1:], dtype=current.dtype)
+            buffer[:n_old] = current
+        buffer[n_old : n_old + n_new] = np.reshape(rows, (n_new,) + current.shape[1:])
+        grown = buffer[: n_old + n_new]
+        row_buffers[name] = (buffer, grown)
+        setattr(self, name, grown)
+
+    def _align_genes(self, X, gene_names):
+        if not hasattr(self, "gene_names"):
+            raise ValueError("The dataset has no gene_names to align the new cells on")
+        gene_index = getattr(self, "_gene_index", None)
+        if gene_index is None:
+            gene_index = {name: i for i, name in enumerate(self.gene_names)}
+            self._gene_index = gene_index
+        gene_names = np.array(gene_names, dtype=np.str)
+        dest = np.array([gene_index.get(name, -1) for name in gene_names])
+        src = np.where(dest >= 0)[0]
+        dest = dest[src]
+        if len(src) < len(gene_names):
+            logging.info(
+                "%d genes of the new cells are not in the dataset and were dropped"
+                % (len(gene_names) - len(src))
+            )
+        if len(src) == self.nb_genes and (dest == np.arange(self.nb_genes)).all():
+            return X[:, src] if len(src) < X.shape[1] else X
+        if isinstance(X, np.ndarray):
+            aligned = np.zeros((X.shape[0], self.nb_genes), dtype=np.float32)
+            aligned[:, dest] = X[:, src]
+            return aligned
+        X = sp_sparse.csr_matrix(X)[:, src].tocoo()
+        return sp_sparse.csr_matrix(
+            (X.data, (X.row, dest[X.col])), shape=(X.shape[0], self.nb_genes)
+        )
+
+    def _grow_X(self, X):
+        # self._X is a view on the first rows of a buffer whose capacity doubles when exceeded,
+        # so that appending cells is amortized linear in the size of the appended cells
+        n_old, n_new = len(self), X.shape[0]
+        grown = getattr(self, "_X_grown", None)
+        if self.dense:
+            X = np.asarray(
+                X.toarray() if sp_sparse.issparse(X) else X, dtype=np.float32
+            )
+            buffer = getattr(self, "_X_buffer", None)
+            if grown is not self._X or len(buffer) < n_old + n_new:
+                capacity = max(2 * n_old, n_old + n_new)
+                buffer = np.empty((capacity, self.nb_genes), dtype=np.float32)
+                buffer[:n_old] = self._X
+            buffer[n_old : n_old + n_new] = X
+            self._X_buffer, self._X_grown = buffer, buffer[: n_old + n_new]
+            return self._X_grown
+
+        old = self._X if sp_sparse.isspmatrix_csr(self._X) else self._X.tocsr()
+        X = sp_sparse.csr_matrix(X, dtype=old.dtype)
+        nnz_old, nnz_new = old.nnz, X.nnz
+        buffers = getattr(self, "_X_buffer", None)
+        if (
+            grown is not self._X
+            or len(buffers[0]) < nnz_old + nnz_new
+            or len(buffers[2]) < n_old + n_new + 1
+        ):
+            nnz_capacity = max(2 * nnz_old, nnz_old + nnz_new)
+            rows_capacity = max(2 * n_old, n_old + n_new) + 1
+            index_dtype = np.int64 if nnz_capacity >= 2 ** 31 else np.int32
+            buffers = (
+                np.empty(nnz_capacity, dtype=old.dtype),
+                np.empty(nnz_capacity, dtype=index_dtype),
+                np.empty(rows_capacity, dtype=index_dtype),
+            )
+            buffers[0][:nnz_old] = old.data
+            buffers[1][:nnz_old] = old.indices
+            buffers[2][: n_old + 1] = old.indptr
+        data, indices, indptr = buffers
+        data[nnz_old : nnz_old + nnz_new] = X.data
+        indices[nnz_old : nnz_old + nnz_new] = X.indices
+        indptr[n_old + 1 : n_old + n_new + 1] = X.indptr[1:] + nnz_old
+        self._X_buffer = buffers
+        self._X_grown = sp_sparse.csr_matrix(
+            (
+                data[: nnz_old + nnz_new],
+                indices[: nnz_old + nnz_new],
+                indptr[: n_old + n_new + 1],
+            ),
+            shape=(n_old + n_new, self.nb_genes),
+        )
+        return self._X_grown
+
     def subsample_genes(self, new_n_genes=None, subset_genes=None):
         n_cells, n_genes = self.X.shape
         if subset_genes is None and (new_n_genes is False or new_n_genes >= n_genes):
             return None  # Do nothing if subsample more genes than total number of genes
         if subset_genes is None:
+            from sklearn.preprocessing import StandardScaler
+
             std_scaler = StandardScaler(with_mean=False)
             std_scaler.fit(self.X.astype(np.float64))
             subset_genes = np.argsort(std_scaler.var_)[::-1][:new_n_genes]
@@ -279,49 +544,108 @@ class GeneExpressionDataset(Dataset):
         for cell_types, new_cell_type_name in cell_types_dict.items():
             self.merge_cell_types(cell_types, new_cell_type_name)
 
-    def download(self):
+    def download(self, n_workers=4):
         if hasattr(self, "urls") and hasattr(self, "download_names"):
-            for url, download_name in zip(self.urls, self.download_names):
-                GeneExpressionDataset._download(url, self.save_path, download_name)
+            checksums = getattr(self, "checksums", [None] * len(self.urls))
+            n_workers = max(1, min(n_workers, len(self.urls)))
+            with ThreadPoolExecutor(n_workers) as executor:
+                futures = [
+                    executor.submit(
+                        GeneExpressionDataset._download,
+                        url,
+                        self.save_path,
+                        download_name,
+                        checksum,
+                    )
+                    for url, download_name, checksum in zip(
+                        self.urls, self.download_names, checksums
+                    )
+                ]
+                for future in futures:
+                    future.result()
         elif hasattr(self, "url") and hasattr(self, "download_name"):
             GeneExpressionDataset._download(
-                self.url, self.save_path, self.download_name
+                self.url,
+                self.save_path,
+                self.download_name,
+                getattr(self, "checksum", None),
             )
 
     @staticmethod
-    def _download(url, save_path, download_name):
-        if os.path.exists(os.path.join(save_path, download_name)):
-            logging.info(
-                "File %s already downloaded" % (os.path.join(save_path, download_name))
-            )
+    def _download(url, save_path, download_name, checksum=None, blocksize=1 << 20):
+        """
+        Downloads ``url`` to ``save_path/download_name``. Data is first written to a ``.part`` file, which is
+        resumed with an HTTP Range request if a previous download was interrupted, and only renamed to its final
+        name once complete (and verified against ``checksum`` if given). The download restarts from scratch if
+        the server answers with another range than the one requested.
+        :param checksum: expected digest of the file, as ``"<algorithm>:<hex digest>"`` (e.g. ``"md5:..."``),
+            a bare hex digest is taken as sha256
+        :param blocksize: size of the buffered reads
+        """
+        path = os.path.join(save_path, download_name)
+        if os.path.exists(path):
+            logging.info("File %s already downloaded" % path)
             return
         if url is None:
             logging.info(
                 "You are trying to load a local file named %s and located at %s "
                 "but this file was not found at the location %s"
-                % (download_name, save_path, os.path.join(save_path, download_name))
+                % (download_name, save_path, path)
             )
-        r = urllib.request.urlopen(url)
-        logging.info("Downloading file at %s" % os.path.join(save_path, download_name))
-
-        def readIter(f, blocksize=1000):
-            """Given a file 'f', returns an iterator that returns bytes of
-            size 'blocksize' from the file, using read()."""
-            while True:
-                data = f.read(blocksize)
-                if not data:
-                    break
-                yield data
 
-        # Create the path to save the data
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+        import urllib.error
+        import urllib.request
 
-        with open(os.path.join(save_path, download_name), "wb") as f:
-            for data in readIter(r):
-                f.write(data)
+        # Create the path to save the data
+        os.makedirs(save_path, exist_ok=True)
+
+        part_path = path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", "bytes=%d-" % offset)
+        try:
+            r = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:  # 416: the partial file is already complete
+                raise
+            logging.info("File %s already fully downloaded" % part_path)
+        else:
+            resume = offset and r.getcode() == 206
+            if resume:
+                # appending another range than the requested one would corrupt the partial file
+                match = re.match(r"bytes (\d+)-", r.headers.get("Content-Range", ""))
+                if match is None or int(match.group(1)) != offset:
+                    logging.info(
+                        "Server did not resume %s at byte %d, restarting"
+                        % (path, offset)
+                    )
+                    r.close()
+                    r = urllib.request.urlopen(url)
+                    resume = False
+            if resume:
+                logging.info("Resuming download of %s at byte %d" % (path, offset))
+            else:
+                logging.info("Downloading file at %s" % path)
+            with r, open(part_path, "ab" if resume else "wb") as f:
+                shutil.copyfileobj(r, f, blocksize)
+
+        if checksum is not None:
+            algorithm, _, digest = checksum.rpartition(":")
+            file_hash = hashlib.new(algorithm or "sha256")
+            with open(part_path, "rb") as f:
+                for data in iter(lambda: f.read(blocksize), b""):
+                    file_hash.update(data)
+            if file_hash.hexdigest() != digest.lower():
+                os.remove(part_path)
+                raise ValueError(
+                    "Checksum mismatch for %s: expected %s, got %s"
+                    % (url, digest, file_hash.hexdigest())
+                )
+        os.replace(part_path, path)
 
     def library_size_batch(self):
+        self._library_stats = None
         for i_batch in range(self.n_batches):
             idx_batch = (self.batch_indices == i_batch).ravel()
             self.local_means[idx_batch], self.local_vars[idx_batch] = self.library_size(
@@ -456,18 +780,32 @@ class GeneExpressionDataset(Dataset):
         ]
         logging.info("Keeping %d genes" % len(gene_names_ref))
 
-        Xs = [
-            GeneExpressionDataset._filter_genes(dataset, gene_names_ref, on=on)[0]
-            for dataset in gene_datasets
-        ]
+        # The gene-filtered blocks are written one dataset at a time into the output, so that at most one
+        # filtered copy is alive besides the result (dense case)
+        n_cells = sum(len(gene_dataset) for gene_dataset in gene_datasets)
         if gene_datasets[0].dense:
-            X = np.concatenate([X if type(X) is np.ndarray else X.A for X in Xs])
+            X = np.empty((n_cells, len(gene_names_ref)), dtype=np.float32)
+            current_index = 0
+            for gene_dataset in gene_datasets:
+                X_filtered = GeneExpressionDataset._filter_genes(
+                    gene_dataset, gene_names_ref, on=on
+                )[0]
+                next_index = current_index + X_filtered.shape[0]
+                X[current_index:next_index] = (
+                    X_filtered if type(X_filtered) is np.ndarray else X_filtered.A
+                )
+                current_index = next_index
         else:
             X = sp_sparse.vstack(
                 [
-                    X if type(X) is not np.ndarray else sp_sparse.csr_matrix(X)
-                    for X in Xs
-                ]
+                    sp_sparse.csr_matrix(
+                        GeneExpressionDataset._filter_genes(
+                            gene_dataset, gene_names_ref, on=on
+                        )[0]
+                    )
+                    for gene_dataset in gene_datasets
+                ],
+                format="csr",
             )
 
         batch_indices = np.zeros((X.shape[0], 1))
@@ -553,6 +891,27 @@ class GeneExpressionDataset(Dataset):
         return gene_dataset.X[:, subset_genes], subset_genes
 
 
+def load_datasets(*constructors, n_workers=None, use_processes=False):
+    """
+    Builds several datasets concurrently, so that their downloads, decompression and parsing overlap and the
+    total construction time approaches that of the largest one.
+    :param constructors: callables without arguments returning a dataset,
+        e.g. ``functools.partial(Dataset10X, "pbmc4k", save_path=save_path)``
+    :param n_workers: maximum number of datasets built at the same time. Default: number of constructors.
+    :param use_processes: build in a process pool (constructors must then be picklable) instead of threads.
+        Processes speed up CPU bound parsing, threads are enough when downloads dominate.
+    :return: the list of datasets, in the order of ``constructors``
+    """
+    n_workers = len(constructors) if n_workers is None else n_workers
+    n_workers = max(1, min(n_workers, len(constructors)))
+    if n_workers == 1:
+        return [constructor() for constructor in constructors]
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(n_workers) as executor:
+        futures = [executor.submit(constructor) for constructor in constructors]
+        return [future.result() for future in futures]
+
+
 def arrange_categories(original_categories, mapping_from=None, mapping_to=None):
     unique_categories = np.unique(original_categories)
     n_categories = len(unique_categories)
@@ -7,13 +7,14 @@ import os
 import pickle
 import tarfile
 import logging
+from functools import partial
 
 import numpy as np
 import pandas as pd
 from scipy import io
 from scipy.sparse import csr_matrix
 
-from scvi.dataset import GeneExpressionDataset
+from scvi.dataset.dataset import GeneExpressionDataset, load_datasets
 
 available_datasets = {
     "1.1.0": [
@@ -205,13 +206,16 @@ class BrainSmallDataset(Dataset10X):
     """
 
     def __init__(self, save_path="data/"):
-        dataset = Dataset10X(filename="neuron_9k", save_path=save_path)
         self.save_path = save_path
         self.urls = [
             "https://github.com/YosefLab/scVI-data/raw/master/brain_small_metadata.pickle"
         ]
         self.download_names = ["brain_small_metadata.pickle"]
-        self.download()
+        # the metadata is fetched while the 10X dataset is built
+        dataset, _ = load_datasets(
+            partial(Dataset10X, filename="neuron_9k", save_path=save_path),
+            self.download,
+        )
 
         metadata = pickle.load(
             open(os.path.join(self.save_path, "brain_small_metadata.pickle"), "rb")
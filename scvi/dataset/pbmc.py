@@ -1,9 +1,11 @@
 import pickle
 import os
+from functools import partial
+
 import numpy as np
 import pandas as pd
 
-from .dataset import GeneExpressionDataset, arrange_categories
+from .dataset import GeneExpressionDataset, arrange_categories, load_datasets
 from .dataset10X import Dataset10X
 
 
@@ -19,13 +21,16 @@ class PbmcDataset(GeneExpressionDataset):
 
     Args:
         :save_path: Save path of raw data file. Default: ``'data/'``.
+        :n_workers: Number of 10X datasets built concurrently. Default: ``None`` (all of them).
+        :use_processes: Whether to build the 10X datasets in a process pool instead of threads.
+            Default: ``False``.
 
     Examples:
         >>> gene_dataset = PbmcDataset()
 
     """
 
-    def __init__(self, save_path="data/"):
+    def __init__(self, save_path="data/", n_workers=None, use_processes=False):
         self.save_path = save_path
         self.urls = [
             "https://github.com/YosefLab/scVI-data/raw/master/gene_info.csv",
@@ -43,8 +48,12 @@ class PbmcDataset(GeneExpressionDataset):
         )
 
         pbmc = GeneExpressionDataset.concat_datasets(
-            Dataset10X("pbmc8k", save_path=save_path),
-            Dataset10X("pbmc4k", save_path=save_path),
+            *load_datasets(
+                partial(Dataset10X, "pbmc8k", save_path=save_path),
+                partial(Dataset10X, "pbmc4k", save_path=save_path),
+                n_workers=n_workers,
+                use_processes=use_processes,
+            )
         )
         self.barcodes = pd.concat(pbmc.barcodes).values.ravel().astype(str)
         super().__init__(
@@ -101,13 +110,23 @@ class PurifiedPBMCDataset(GeneExpressionDataset):
 
     Args:
         :save_path: Save path of raw data file. Default: ``'data/'``.
+        :filter_cell_types: Indices of the cell types to keep. Default: ``None`` (all of them).
+        :n_workers: Number of 10X datasets built concurrently. Default: ``None`` (all of them).
+        :use_processes: Whether to build the 10X datasets in a process pool instead of threads.
+            Default: ``False``.
 
     Examples:
         >>> gene_dataset = PurifiedPBMCDataset()
 
     """
 
-    def __init__(self, save_path="data/", filter_cell_types=None):
+    def __init__(
+        self,
+        save_path="data/",
+        filter_cell_types=None,
+        n_workers=None,
+        use_processes=False,
+    ):
         cell_types = np.array(
             [
                 "cd4_t_helper",
@@ -128,11 +147,22 @@ class PurifiedPBMCDataset(GeneExpressionDataset):
         ):  # filter = np.arange(6) - for T cells:  np.arange(4) for T/CD4 cells
             cell_types = cell_types[np.array(filter_cell_types)]
 
-        datasets = []
-        for cell_type in cell_types:
-            dataset = Dataset10X(cell_type, save_path=save_path)
+        # each 10X dataset is built once, even if its cell type is listed twice
+        unique_cell_types = list(dict.fromkeys(cell_types))
+        unique_datasets = load_datasets(
+            *[
+                partial(Dataset10X, cell_type, save_path=save_path)
+                for cell_type in unique_cell_types
+            ],
+            n_workers=n_workers,
+            use_processes=use_processes,
+        )
+        for dataset, cell_type in zip(unique_datasets, unique_cell_types):
             dataset.cell_types = np.array([cell_type])
-            datasets += [dataset]
+        datasets = [
+            unique_datasets[unique_cell_types.index(cell_type)]
+            for cell_type in cell_types
+        ]
 
         pbmc = GeneExpressionDataset.concat_datasets(*datasets, shared_batches=True)
         pbmc.subsample_genes(subset_genes=(np.array(pbmc.X.sum(axis=0)) > 0).ravel())
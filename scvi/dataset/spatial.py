@@ -0,0 +1,103 @@
+"""Spatial indexing of cell coordinates."""
+import numpy as np
+
+
+class SpatialGrid:
+    r"""Uniform grid index over 2D cell coordinates.
+
+    Cells are bucketed into square grid cells of side ``cell_size`` and stored sorted by bucket, so that radius
+    and region queries only look at the cells of the few buckets that overlap the query.
+
+    Args:
+        :x_coord: x coordinate of each cell.
+        :y_coord: y coordinate of each cell.
+        :cell_size: Side of a grid cell. Default: ``None``, chosen so that a grid cell holds about
+            ``cells_per_bucket`` cells on average.
+        :cells_per_bucket: Average number of cells per grid cell when ``cell_size`` is not given. Default: ``8``.
+
+    Examples:
+        >>> grid = SpatialGrid(gene_dataset.x_coord, gene_dataset.y_coord)
+        >>> grid.radius_query(x, y, radius=50)
+    """
+
+    def __init__(self, x_coord, y_coord, cell_size=None, cells_per_bucket=8):
+        self.coords = np.stack(
+            [
+                np.asarray(x_coord, dtype=np.float64).ravel(),
+                np.asarray(y_coord, dtype=np.float64).ravel(),
+            ],
+            axis=1,
+        )
+        self.origin = self.coords.min(axis=0)
+        extent = self.coords.max(axis=0) - self.origin
+        if cell_size is None:
+            area = np.prod(extent) if np.prod(extent) > 0 else np.max(extent) ** 2
+            cell_size = np.sqrt(area * cells_per_bucket / len(self.coords))
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+        self.shape = np.floor(extent / self.cell_size).astype(np.int64) + 1
+
+        cells = self._bucket(self.coords)
+        keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(keys, kind="stable")
+        self.bucket_starts = np.concatenate(
+            [[0], np.cumsum(np.bincount(keys, minlength=np.prod(self.shape)))]
+        )
+        self.locality_keys = _morton_keys(cells[:, 0], cells[:, 1])
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _bucket(self, coords):
+        cells = np.floor((coords - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self.shape - 1)
+
+    def _candidates(self, x_min, x_max, y_min, y_max):
+        (i_min, j_min), (i_max, j_max) = self._bucket(
+            np.array([[x_min, y_min], [x_max, y_max]])
+        )
+        rows = np.arange(i_min, i_max + 1) * self.shape[1]
+        starts = self.bucket_starts[rows + j_min]
+        ends = self.bucket_starts[rows + j_max + 1]
+        # within a row of the grid, the buckets j_min..j_max are stored contiguously
+        return np.concatenate(
+            [self.order[start:end] for start, end in zip(starts, ends)]
+            + [np.array([], dtype=np.int64)]
+        )
+
+    def region_query(self, x_min, x_max, y_min, y_max):
+        r"""Indices of the cells with ``x_min <= x <= x_max`` and ``y_min <= y <= y_max``, in increasing order."""
+        candidates = self._candidates(x_min, x_max, y_min, y_max)
+        x, y = self.coords[candidates].T
+        inside = (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+        return np.sort(candidates[inside])
+
+    def radius_query(self, x, y, radius):
+        r"""Indices of the cells within ``radius`` of ``(x, y)``, in increasing order."""
+        candidates = self._candidates(x - radius, x + radius, y - radius, y + radius)
+        distances = np.sum((self.coords[candidates] - [x, y]) ** 2, axis=1)
+        return np.sort(candidates[distances <= radius ** 2])
+
+    def neighbors(self, indices, radius, subset=None):
+        r"""For each cell of ``indices``, the other cells within ``radius``, optionally restricted to ``subset``.
+
+        :return: a list of arrays of cell indices
+        """
+        mask = None
+        if subset is not None:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[subset] = True
+        neighbors = []
+        for idx in indices:
+            close = self.radius_query(*self.coords[idx], radius)
+            close = close[close != idx]
+            neighbors.append(close if mask is None else close[mask[close]])
+        return neighbors
+
+
+def _morton_keys(i, j, n_bits=21):
+    # interleave the bits of the grid coordinates so that cells close in key order are close in space
+    keys = np.zeros(len(i), dtype=np.int64)
+    for bit in range(n_bits):
+        keys |= ((i >> bit) & 1) << (2 * bit + 1)
+        keys |= ((j >> bit) & 1) << (2 * bit)
+    return keys
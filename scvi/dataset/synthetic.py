@@ -1,7 +1,10 @@
 import pickle
 import os
 import logging
+
+import h5py
 import numpy as np
+import scipy.sparse as sp_sparse
 
 from . import GeneExpressionDataset
 
@@ -249,3 +252,166 @@ class ZISyntheticDatasetCorr(SyntheticDatasetCorr):
         assert np.abs(self.probas_zero_bio_tech_high.sum() - 1) <= 1e-8
         assert np.abs(self.probas_zero_bio_tech_low.sum() - 1) <= 1e-8
         return data * mask.astype(np.float32)
+
+
+def synthetic_corr_params(
+    n_clusters=3,
+    n_genes_high=25,
+    n_overlap=0,
+    weight_high=4e-2,
+    weight_low=1e-2,
+    lam_0=50.0,
+):
+    """
+    Poisson parameters of the ``SyntheticDatasetCorr`` clusters: the genes of each cluster's window of
+    ``n_genes_high`` genes (shifted by ``n_genes_high - n_overlap`` from one cluster to the next) are highly expressed.
+    :return: the Poisson parameters and the highly expressed genes, both of shape ``(n_clusters, n_genes_total)``
+    """
+    if n_overlap == 0:
+        n_genes_total = n_clusters * n_genes_high
+    else:
+        n_genes_total = n_clusters * (n_genes_high - n_overlap) + n_overlap
+    exprs_param = np.empty((n_clusters, n_genes_total))
+    is_highly_exp = np.zeros((n_clusters, n_genes_total), dtype=bool)
+    for cluster in range(n_clusters):
+        ind_first_gene_cluster = cluster * (n_genes_high - n_overlap)
+        ind_last_high_gene_cluster = ind_first_gene_cluster + n_genes_high
+        is_highly_exp[cluster, ind_first_gene_cluster:ind_last_high_gene_cluster] = True
+        weights = np.where(is_highly_exp[cluster], weight_high, weight_low)
+        exprs_param[cluster] = lam_0 * weights / weights.sum()
+    return exprs_param, is_highly_exp
+
+
+def iter_sparse_synthetic_corr(
+    n_cells_cluster=200,
+    n_clusters=3,
+    dropout_coef_high=0.0,
+    lam_dropout_high=0.0,
+    dropout_coef_low=0.0,
+    lam_dropout_low=0.0,
+    chunk_size=10000,
+    seed=0,
+    **kwargs
+):
+    """
+    Generates the counts of a ``SyntheticDatasetCorr`` (or, with dropout coefficients, of a
+    ``ZISyntheticDatasetCorr``) by chunks of ``chunk_size`` cells, ordered by cluster.
+    Chunk ``i`` is drawn from its own random stream seeded by ``(seed, i)``, so chunks are reproducible
+    and independent of the chunk order, and only one dense chunk is ever held in memory.
+    :param kwargs: the cluster parameters of ``synthetic_corr_params``
+    :return: an iterator of (CSR counts, labels) pairs
+    """
+    exprs_param, is_highly_exp = synthetic_corr_params(n_clusters=n_clusters, **kwargs)
+    p_dropout = np.where(
+        is_highly_exp,
+        dropout_coef_high * np.exp(-lam_dropout_high * (exprs_param ** 2)),
+        dropout_coef_low * np.exp(-lam_dropout_low * (exprs_param ** 2)),
+    )
+    n_cells = n_cells_cluster * n_clusters
+    for i_chunk, start in enumerate(range(0, n_cells, chunk_size)):
+        random_state = np.random.RandomState([seed, i_chunk])
+        labels = np.arange(start, min(start + chunk_size, n_cells)) // n_cells_cluster
+        counts = random_state.poisson(exprs_param[labels]).astype(np.float32)
+        if p_dropout.any():
+            counts *= random_state.random_sample(counts.shape) >= p_dropout[labels]
+        yield sp_sparse.csr_matrix(counts), labels
+
+
+def write_sparse_synthetic_corr(path, **kwargs):
+    """
+    Streams the chunks of ``iter_sparse_synthetic_corr`` to an HDF5 file holding the CSR ``data``, ``indices``,
+    ``indptr``, ``shape`` and ``labels`` of the cells x genes matrix, without holding the matrix in memory.
+    :param path: path of the HDF5 file
+    :param kwargs: keyword arguments of ``iter_sparse_synthetic_corr``
+    """
+    with h5py.File(path, "w") as f:
+        datasets = {
+            name: f.create_dataset(
+                name, (0,), dtype=dtype, maxshape=(None,), chunks=True
+            )
+            for name, dtype in [
+                ("data", np.float32),
+                ("indices", np.int32),
+                ("indptr", np.int64),
+                ("labels", np.int64),
+            ]
+        }
+        datasets["indptr"].resize((1,))
+        datasets["indptr"][0] = 0
+        n_genes = 0
+        for counts, labels in iter_sparse_synthetic_corr(**kwargs):
+            n_genes = counts.shape[1]
+            nnz = datasets["indptr"][-1]
+            for name, values in [
+                ("data", counts.data),
+                ("indices", counts.indices),
+                ("indptr", counts.indptr[1:] + nnz),
+                ("labels", labels),
+            ]:
+                dataset = datasets[name]
+                dataset.resize((len(dataset) + len(values),))
+                dataset[-len(values) :] = values
+        f.create_dataset("shape", data=[len(datasets["labels"]), n_genes])
+
+
+def read_sparse_synthetic_corr(path):
+    """
+    :return: the CSR counts and the labels stored by ``write_sparse_synthetic_corr``
+    """
+    with h5py.File(path, "r") as f:
+        X = sp_sparse.csr_matrix(
+            (f["data"][...], f["indices"][...], f["indptr"][...]),
+            shape=tuple(f["shape"][...]),
+        )
+        labels = f["labels"][...]
+    return X, labels
+
+
+class SparseSyntheticDatasetCorr(GeneExpressionDataset):
+    r"""Sparse, chunked version of ``ZISyntheticDatasetCorr``, scaling to millions of cells.
+
+    The counts follow the same cluster, overlap and dropout semantics (no dropout by default, as in
+    ``SyntheticDatasetCorr``) but are generated by chunks straight into a CSR matrix.
+
+    Args:
+        :n_cells_cluster: Number of cells in each cluster. Default: ``200``.
+        :n_clusters: Number of cell clusters. Default: ``3``.
+        :chunk_size: Number of cells generated at once. Default: ``10000``.
+        :seed: Seed of the chunks' random streams. Default: ``0``.
+        :path: Optional HDF5 file where the counts are streamed first, and read from if it already exists.
+            Default: ``None``.
+        :\*\*kwargs: Other keyword arguments of ``synthetic_corr_params`` and ``iter_sparse_synthetic_corr``
+            (``n_genes_high``, ``n_overlap``, ``weight_high``, ``weight_low``, ``lam_0``, dropout coefficients).
+
+    Examples:
+        >>> gene_dataset = SparseSyntheticDatasetCorr(n_cells_cluster=500000, n_clusters=2)
+
+    """
+
+    def __init__(
+        self,
+        n_cells_cluster=200,
+        n_clusters=3,
+        chunk_size=10000,
+        seed=0,
+        path=None,
+        **kwargs
+    ):
+        kwargs.update(
+            n_cells_cluster=n_cells_cluster,
+            n_clusters=n_clusters,
+            chunk_size=chunk_size,
+            seed=seed,
+        )
+        if path is not None:
+            if not os.path.exists(path):
+                write_sparse_synthetic_corr(path, **kwargs)
+            X, labels = read_sparse_synthetic_corr(path)
+        else:
+            chunks = list(iter_sparse_synthetic_corr(**kwargs))
+            X = sp_sparse.vstack([counts for counts, _ in chunks], format="csr")
+            labels = np.concatenate([labels for _, labels in chunks])
+        super().__init__(
+            *GeneExpressionDataset.get_attributes_from_matrix(X, labels=labels),
+            gene_names=np.arange(X.shape[1]).astype(np.str)
+        )
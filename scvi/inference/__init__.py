@@ -1,14 +1,35 @@
+import importlib
+
 from .posterior import Posterior
 from .trainer import Trainer
 from .inference import UnsupervisedTrainer, AdapterTrainer
-from .annotation import (
-    JointSemiSupervisedTrainer,
-    SemiSupervisedTrainer,
-    AlternateSemiSupervisedTrainer,
-    ClassifierTrainer,
-)
-from .fish import TrainerFish
-from .autotune import auto_tune_scvi_model, hyperopt_worker, launch_workers
+
+# the other trainers and the hyperoptimization tools are imported on first access
+_lazy_imports = {
+    "JointSemiSupervisedTrainer": ".annotation",
+    "SemiSupervisedTrainer": ".annotation",
+    "AlternateSemiSupervisedTrainer": ".annotation",
+    "ClassifierTrainer": ".annotation",
+    "TrainerFish": ".fish",
+    "DistributedUnsupervisedTrainer": ".distributed",
+    "HogwildTrainer": ".hogwild",
+    "auto_tune_scvi_model": ".autotune",
+    "hyperopt_worker": ".autotune",
+    "launch_workers": ".autotune",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_imports))
+
 
 __all__ = [
     "Trainer",
@@ -20,6 +41,8 @@ __all__ = [
     "SemiSupervisedTrainer",
     "AlternateSemiSupervisedTrainer",
     "ClassifierTrainer",
+    "DistributedUnsupervisedTrainer",
+    "HogwildTrainer",
     "auto_tune_scvi_model",
     "hyperopt_worker",
     "launch_workers",
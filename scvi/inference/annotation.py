@@ -3,19 +3,13 @@ from collections import namedtuple
 import numpy as np
 import logging
 
-from sklearn import neighbors
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import GridSearchCV
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.svm import SVC
-
 import torch
 from torch.nn import functional as F
 
 from scvi.inference import Posterior
 from scvi.inference import Trainer
 from scvi.inference.inference import UnsupervisedTrainer
-from scvi.inference.posterior import unsupervised_clustering_accuracy
+from scvi.inference.posterior import group_ranks, unsupervised_clustering_accuracy
 
 logger = logging.getLogger(__name__)
 
@@ -77,6 +71,8 @@ class AnnotationPosterior(Posterior):
 
     @torch.no_grad()
     def nn_latentspace(self, posterior):
+        from sklearn.neighbors import KNeighborsClassifier
+
         data_train, _, labels_train = self.get_latent()
         data_test, _, labels_test = posterior.get_latent()
         nn = KNeighborsClassifier()
@@ -203,26 +199,14 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
         self.n_epochs_classifier = n_epochs_classifier
         self.lr_classification = lr_classification
         self.classification_ratio = classification_ratio
-        n_labelled_samples_per_class_array = [
-            n_labelled_samples_per_class
-        ] * self.gene_dataset.n_labels
         labels = np.array(self.gene_dataset.labels).ravel()
         np.random.seed(seed=seed)
         permutation_idx = np.random.permutation(len(labels))
-        labels = labels[permutation_idx]
-        indices = []
-        current_nbrs = np.zeros(len(n_labelled_samples_per_class_array))
-        for idx, (label) in enumerate(labels):
-            label = int(label)
-            if current_nbrs[label] < n_labelled_samples_per_class_array[label]:
-                indices.insert(0, idx)
-                current_nbrs[label] += 1
-            else:
-                indices.append(idx)
-        indices = np.array(indices)
-        total_labelled = sum(n_labelled_samples_per_class_array)
-        indices_labelled = permutation_idx[indices[:total_labelled]]
-        indices_unlabelled = permutation_idx[indices[total_labelled:]]
+        # the first n_labelled_samples_per_class cells of each class in the permutation are labelled
+        ranks, _ = group_ranks(labels[permutation_idx].astype(np.int64))
+        is_labelled = ranks < n_labelled_samples_per_class
+        indices_labelled = permutation_idx[np.flatnonzero(is_labelled)[::-1]]
+        indices_unlabelled = permutation_idx[np.flatnonzero(~is_labelled)]
 
         self.classifier_trainer = ClassifierTrainer(
             model.classifier,
@@ -231,9 +215,10 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
             show_progbar=False,
             frequency=0,
             sampling_model=self.model,
+            mixed_precision=self.mixed_precision,
         )
         self.full_dataset = self.create_posterior(shuffle=True)
-        self.labelled_set = self.create_posterior(indices=indices_labelled)
+        self.labelled_set = self.create_posterior(indices=indices_labelled).stratified()
         self.unlabelled_set = self.create_posterior(indices=indices_unlabelled)
 
         for posterior in [self.labelled_set, self.unlabelled_set]:
@@ -243,6 +228,9 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
     def posteriors_loop(self):
         return ["full_dataset", "labelled_set"]
 
+    # the training losses ignore the labels that the elbo of the annotation posteriors uses
+    running_elbo_posterior = None
+
     def __setattr__(self, key, value):
         if key == "labelled_set":
             self.classifier_trainer.train_set = value
@@ -373,7 +361,9 @@ def compute_accuracy_tuple(y, y_pred):
 
 @torch.no_grad()
 def compute_accuracy_nn(data_train, labels_train, data_test, labels_test, k=5):
-    clf = neighbors.KNeighborsClassifier(k, weights="distance")
+    from sklearn.neighbors import KNeighborsClassifier
+
+    clf = KNeighborsClassifier(k, weights="distance")
     return compute_accuracy_classifier(
         clf, data_train, labels_train, data_test, labels_test
     )
@@ -410,6 +400,9 @@ def compute_accuracy_svc(
             {"C": [1, 10, 100, 1000], "kernel": ["linear"]},
             {"C": [1, 10, 100, 1000], "gamma": [0.001, 0.0001], "kernel": ["rbf"]},
         ]
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.svm import SVC
+
     svc = SVC(max_iter=max_iter)
     clf = GridSearchCV(svc, param_grid, verbose=verbose)
     return compute_accuracy_classifier(
@@ -423,6 +416,9 @@ def compute_accuracy_rf(
 ):
     if param_grid is None:
         param_grid = {"max_depth": np.arange(3, 10), "n_estimators": [10, 50, 100, 200]}
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import GridSearchCV
+
     rf = RandomForestClassifier(max_depth=2, random_state=0)
     clf = GridSearchCV(rf, param_grid, verbose=verbose)
     return compute_accuracy_classifier(
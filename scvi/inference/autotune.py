@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import datetime
 import logging
 import multiprocessing
@@ -12,27 +14,23 @@ from functools import partial, wraps
 from io import IOBase
 from logging.handlers import QueueListener, QueueHandler
 from subprocess import Popen
-from typing import Any, Callable, Dict, List, Type, Union
+from typing import Any, Callable, Dict, List, Type, Union, TYPE_CHECKING
 from queue import Empty
 
-from hyperopt import fmin, tpe, Trials, hp, STATUS_OK, STATUS_FAIL
-from hyperopt.mongoexp import (
-    as_mongo_str,
-    MongoJobs,
-    MongoTrials,
-    MongoWorker,
-    ReserveTimeout,
-)
-
 import numpy as np
 import torch
-import tqdm
 
 from . import Trainer
 from .inference import UnsupervisedTrainer
 from ..dataset import GeneExpressionDataset
 from ..models import VAE
 
+# hyperopt and tqdm are only imported when hyperoptimization is actually run
+if TYPE_CHECKING:
+    import tqdm
+    from hyperopt import Trials
+    from hyperopt.mongoexp import MongoTrials
+
 # TODO: add database watcher and visualizations
 # TODO: make worker_launcher a subclass of threading.Thread
 # TODO: and hyperopt_worker a subclass of multiprocessing.Process
@@ -245,6 +243,8 @@ def auto_tune_scvi_model(
         >>> gene_dataset = CortexDataset()
         >>> best_trainer, trials = auto_tune_scvi_model(gene_dataset)
     """
+    from hyperopt import fmin, tpe, Trials, hp
+
     if fmin_timer and train_best:
         logger.warning(
             "fmin_timer and train_best are both set to True. "
@@ -472,6 +472,9 @@ def _auto_tune_parallel(
         Therefore, setting this to ``True`` disables the ``fmin_timeout`` behaviour.
     :return: ``MongoTrials`` object containing the results of the program.
     """
+    import tqdm
+    from hyperopt import tpe
+
     # run mongod bash script
     mongo_path = os.path.join(save_path, "mongo")
     if not os.path.exists(mongo_path):
@@ -628,7 +631,7 @@ def _fmin_parallel(
     fn: Callable,
     exp_key: str,
     space: dict,
-    algo: Callable = tpe.suggest,
+    algo: Callable = None,
     max_evals: int = 100,
     fmin_timer: float = None,
     show_progressbar: bool = False,
@@ -636,6 +639,10 @@ def _fmin_parallel(
 ):
     """Launches a ``hyperopt`` minimization procedure.
     """
+    from hyperopt import fmin, tpe
+    from hyperopt.mongoexp import as_mongo_str, MongoTrials
+
+    algo = tpe.suggest if algo is None else algo
     logger.debug("Instantiating trials object.")
     # instantiate Trials object
     trials = MongoTrials(
@@ -905,6 +912,8 @@ def hyperopt_worker(
         before throwing a ``ReserveTimeout`` Exception.
     :param mongo_port_address: Addres to the running MongoDb service.
     """
+    from hyperopt.mongoexp import as_mongo_str, MongoJobs, MongoWorker, ReserveTimeout
+
     # write all logs to queue
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.DEBUG)
@@ -994,6 +1003,8 @@ def _objective_function(
     :param is_best_training: True if training the model with the best hyperparameters
     :return: best value of the early stopping metric, and best model if is_best_training
     """
+    from hyperopt import STATUS_OK, STATUS_FAIL
+
     start_time = time.monotonic()
     # hyperopt params
     space = defaultdict(dict, space)
@@ -0,0 +1,175 @@
+"""Data-parallel training over several CPU processes with ``torch.distributed``."""
+import logging
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from scvi.inference.inference import UnsupervisedTrainer
+
+logger = logging.getLogger(__name__)
+
+
+def launch(function, world_size, args=(), init_method=None, backend="gloo"):
+    r"""Runs ``function(*args)`` in ``world_size`` processes joined in a process group.
+
+    :param function: picklable function, e.g. defined at the top level of a module, that builds a
+        ``DistributedUnsupervisedTrainer`` and trains it
+    :param world_size: number of processes
+    :param args: arguments of ``function``, which must be picklable as well
+    :param init_method: rendezvous of the processes, either a shared file ``"file:///path"`` or a TCP store
+        ``"tcp://host:port"``. Default: a new temporary file.
+    :param backend: backend of ``torch.distributed``. Default: ``"gloo"``.
+    """
+    tmp_path = None
+    if init_method is None:
+        fd, tmp_path = tempfile.mkstemp(prefix="scvi_rendezvous_")
+        os.close(fd)
+        # the file store expects the file not to exist yet, or to be empty
+        os.remove(tmp_path)
+        init_method = "file://" + tmp_path
+    try:
+        mp.spawn(
+            _run,
+            args=(world_size, init_method, backend, function, args),
+            nprocs=world_size,
+            join=True,
+        )
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _run(rank, world_size, init_method, backend, function, args):
+    dist.init_process_group(
+        backend, init_method=init_method, rank=rank, world_size=world_size
+    )
+    try:
+        function(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def broadcast_module(module, src=0):
+    r"""Copies the parameters and buffers of ``module`` on process ``src`` to all the processes."""
+    with torch.no_grad():
+        for tensor in module.state_dict().values():
+            dist.broadcast(tensor, src)
+
+
+class DistributedUnsupervisedTrainer(UnsupervisedTrainer):
+    r"""Data-parallel version of ``UnsupervisedTrainer``, to be built in every process of an initialized
+    process group (see ``launch``).
+
+    Each process trains on its shard of ``train_set`` and the gradients are averaged over the processes
+    before every optimizer step, so that the replicas of the model stay identical. The metrics are only
+    computed by the process of rank 0, except for the training ELBO which is accumulated over all the
+    processes. Its early stopping and learning rate decisions are broadcast to the other processes, and it
+    alone writes the checkpoints. At the end of training, all the processes hold its weights.
+
+    Args:
+        :seed: Seed of the shuffling of the shards, combined with the epoch. Default: ``0``.
+        :\*\*kwargs: Other keywords arguments from the specific ``UnsupervisedTrainer``.
+
+    Examples:
+        >>> def train(save_path):
+        ...     gene_dataset = CortexDataset(save_path=save_path)
+        ...     vae = VAE(gene_dataset.nb_genes)
+        ...     trainer = DistributedUnsupervisedTrainer(vae, gene_dataset, use_cuda=False)
+        ...     trainer.train(n_epochs=400)
+        >>> launch(train, world_size=8, args=("data/",))
+    """
+
+    def __init__(
+        self, model, gene_dataset, train_size=0.8, test_size=None, seed=0, **kwargs
+    ):
+        if not dist.is_initialized():
+            raise RuntimeError(
+                "DistributedUnsupervisedTrainer needs an initialized process group"
+            )
+        super().__init__(model, gene_dataset, **kwargs)
+        # the split is seeded, hence the same in all the processes
+        self.train_set, self.test_set = self.train_test(
+            model, gene_dataset, train_size, test_size
+        )
+        self.train_set.to_monitor = ["elbo"]
+        self.test_set.to_monitor = ["elbo"]
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.seed = seed
+        self._shards = None
+        self._shards_epoch = None
+        broadcast_module(self.model)
+
+    def training_posteriors(self):
+        if self._shards_epoch != self.epoch:
+            self._shards = [
+                posterior.sharded(
+                    self.world_size, self.rank, seed=self.seed + self.epoch + 1
+                )
+                for posterior in super().training_posteriors()
+            ]
+            self._shards_epoch = self.epoch
+        return self._shards
+
+    def before_optimizer_step(self):
+        params = [
+            param
+            for param_group in self.optimizer.param_groups
+            for param in param_group["params"]
+        ]
+        for param in params:
+            if param.grad is None:
+                param.grad = torch.zeros_like(param)
+        # a single all-reduce over the flattened gradients of the model
+        grads = torch.cat([param.grad.view(-1) for param in params])
+        dist.all_reduce(grads)
+        grads /= self.world_size
+        offset = 0
+        for param in params:
+            param.grad.copy_(grads[offset : offset + param.numel()].view_as(param))
+            offset += param.numel()
+
+    def compute_metrics(self):
+        if self.rank == 0:
+            super().compute_metrics()
+
+    def on_epoch_end(self):
+        running = torch.tensor(
+            [
+                float(self._running_reconstruction_loss),
+                float(self._running_kl_divergence),
+                float(self._running_n_cells),
+            ],
+            dtype=torch.float64,
+        )
+        dist.all_reduce(running)
+        self._running_reconstruction_loss = running[0].item()
+        self._running_kl_divergence = running[1].item()
+        self._running_n_cells = int(running[2].item())
+
+        if self.rank == 0:
+            super().on_epoch_end()
+        # the stop reason is broadcast by its index
+        stop_reasons = [None] + self.stop_reasons
+        decision = torch.tensor(
+            [float(stop_reasons.index(self.stop_reason))]
+            + [param_group["lr"] for param_group in self.optimizer.param_groups],
+            dtype=torch.float64,
+        )
+        dist.broadcast(decision, 0)
+        for param_group, lr in zip(self.optimizer.param_groups, decision[1:]):
+            param_group["lr"] = lr.item()
+        self.stop_reason = stop_reasons[int(decision[0].item())]
+        return self.stop_reason is None
+
+    def save_checkpoint(self, path):
+        if self.rank == 0:
+            super().save_checkpoint(path)
+
+    def train(self, *args, **kwargs):
+        super().train(*args, **kwargs)
+        # the best state is only tracked by the process of rank 0
+        broadcast_module(self.model)
@@ -1,3 +1,4 @@
+import copy
 import logging
 import numpy as np
 
@@ -27,6 +28,15 @@ class FishPosterior(Posterior):
         logger.debug("Reconstruction Error Fish: %.4f" % reconstruction_error)
         return reconstruction_error
 
+    def spatial_neighbors(self, radius, indices=None):
+        r"""For each cell of ``indices`` (by default, of the posterior), the cells of the posterior lying within
+        ``radius`` of it, as a list of arrays of indices in the dataset.
+        """
+        indices = self.indices if indices is None else indices
+        return self.gene_dataset.spatial_index.neighbors(
+            indices, radius, subset=self.indices
+        )
+
     @torch.no_grad()
     def show_spatial_expression(
         self,
@@ -108,7 +118,9 @@ class TrainerFish(Trainer):
         self.test_seq.to_monitor = ["reconstruction_error"]
         self.test_fish.to_monitor = ["reconstruction_error"]
 
-    def train(self, n_epochs=20, lr=1e-3, weight_decay=1e-6, params=None):
+    def train(
+        self, n_epochs=20, lr=1e-3, weight_decay=1e-6, params=None, resume_from=None
+    ):
         self.adversarial_cls = Classifier(
             self.model.n_latent, n_labels=self.model.n_batch, n_layers=3
         )
@@ -119,7 +131,18 @@ class TrainerFish(Trainer):
             lr=lr,
             weight_decay=weight_decay,
         )
-        super().train(n_epochs=n_epochs, lr=1e-3, params=None)
+        super().train(n_epochs=n_epochs, lr=1e-3, params=None, resume_from=resume_from)
+
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state["adversarial_cls"] = copy.deepcopy(self.adversarial_cls.state_dict())
+        state["optimizer_cls"] = copy.deepcopy(self.optimizer_cls.state_dict())
+        return state
+
+    def load_checkpoint_state(self, state):
+        super().load_checkpoint_state(state)
+        self.adversarial_cls.load_state_dict(state["adversarial_cls"])
+        self.optimizer_cls.load_state_dict(state["optimizer_cls"])
 
     @property
     def posteriors_loop(self):
@@ -0,0 +1,177 @@
+"""Lock-free training of a shared-memory model by several processes of one machine."""
+import logging
+import queue
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from scvi.inference.inference import UnsupervisedTrainer
+
+logger = logging.getLogger(__name__)
+
+
+class HogwildTrainer(UnsupervisedTrainer):
+    r"""Hogwild version of ``UnsupervisedTrainer``.
+
+    The parameters of the model are moved to shared memory and ``n_workers`` forked processes train them
+    concurrently, each on its own shard of ``train_set`` and with its own optimizer, without any locking.
+    The main process dispatches the epochs, gathers the training losses of the workers and takes care of the
+    metrics and early stopping. The learning rate warmup and ``lr_schedule`` are not supported.
+
+    The workers are forked when ``train`` starts, before the main process runs any computation of it, since
+    forked processes may deadlock in an OpenMP thread pool left by their parent. Torch operations run with
+    several threads before ``train`` carry the same risk, in which case ``n_threads_per_worker=1`` avoids it.
+
+    Args:
+        :n_workers: Number of training processes. Default: ``4``.
+        :n_threads_per_worker: Number of intra-op threads of each worker. Default: ``None``, the threads of
+            the main process are shared between the workers.
+        :seed: Seed of the workers' random streams and of the shuffling of the shards. Default: ``0``.
+        :\*\*kwargs: Other keywords arguments from the specific ``UnsupervisedTrainer``.
+
+    Examples:
+        >>> gene_dataset = CortexDataset()
+        >>> vae = VAE(gene_dataset.nb_genes)
+        >>> trainer = HogwildTrainer(vae, gene_dataset, n_workers=16, use_cuda=False)
+        >>> trainer.train(n_epochs=400)
+    """
+
+    def __init__(
+        self,
+        model,
+        gene_dataset,
+        train_size=0.8,
+        test_size=None,
+        n_workers=4,
+        n_threads_per_worker=None,
+        seed=0,
+        **kwargs
+    ):
+        if kwargs.get("lr_warmup_epochs") or kwargs.get("lr_schedule") is not None:
+            raise ValueError(
+                "The Hogwild workers support neither lr_warmup_epochs nor lr_schedule"
+            )
+        # shared memory training is for CPU nodes
+        kwargs.update(use_cuda=False)
+        super().__init__(model, gene_dataset, **kwargs)
+        self.train_set, self.test_set = self.train_test(
+            model, gene_dataset, train_size, test_size
+        )
+        self.train_set.to_monitor = ["elbo"]
+        self.test_set.to_monitor = ["elbo"]
+        self.n_workers = n_workers
+        self.n_threads_per_worker = n_threads_per_worker
+        self.seed = seed
+        self._worker_rank = None
+        self._workers = None
+        self._shards = None
+        self._shards_epoch = None
+
+    def training_posteriors(self):
+        if self._worker_rank is None:
+            return super().training_posteriors()
+        if self._shards_epoch != self.epoch:
+            self._shards = [
+                posterior.sharded(
+                    self.n_workers, self._worker_rank, seed=self.seed + self.epoch + 1
+                )
+                for posterior in super().training_posteriors()
+            ]
+            self._shards_epoch = self.epoch
+        return self._shards
+
+    def train(self, n_epochs=20, lr=1e-3, eps=0.01, params=None, **kwargs):
+        self.model.share_memory()
+        if params is None:
+            params = filter(lambda p: p.requires_grad, self.model.parameters())
+        params = list(params)
+        # before the metrics of epoch 0, so that the workers do not inherit the OpenMP state of their computation
+        self.start_workers(params, eps)
+        try:
+            super().train(n_epochs=n_epochs, lr=lr, eps=eps, params=params, **kwargs)
+        finally:
+            self.stop_workers()
+
+    def train_epoch(self, lr, n_iter_warmup=0):
+        # the learning rate may have been reduced by the early stopping
+        lr = self.optimizer.param_groups[0]["lr"]
+        for commands in self._commands:
+            commands.put((self.epoch, lr))
+        for _ in range(self.n_workers):
+            result = self.get_result()
+            if isinstance(result, str):
+                raise RuntimeError("A Hogwild worker failed:\n" + result)
+            reconstruction_loss, kl_divergence, n_cells = result
+            self._running_reconstruction_loss += reconstruction_loss
+            self._running_kl_divergence += kl_divergence
+            self._running_n_cells += n_cells
+
+    def get_result(self):
+        # polled, so that a worker killed before reporting does not block the training forever
+        while True:
+            try:
+                return self._results.get(timeout=1)
+            except queue.Empty:
+                for worker in self._workers:
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            "A Hogwild worker exited with code %s" % worker.exitcode
+                        )
+
+    def start_workers(self, params, eps):
+        # the workers are forked so that they share the model and the dataset without copying them
+        context = mp.get_context("fork")
+        self._commands = [context.SimpleQueue() for _ in range(self.n_workers)]
+        self._results = context.Queue()
+        n_threads = self.n_threads_per_worker or max(
+            1, torch.get_num_threads() // self.n_workers
+        )
+        self._workers = [
+            context.Process(
+                target=self._work, args=(rank, n_threads, params, eps), daemon=True
+            )
+            for rank in range(self.n_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def stop_workers(self):
+        if self._workers is None:
+            return
+        for commands in self._commands:
+            commands.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+
+    def _work(self, rank, n_threads, params, eps):
+        self._worker_rank = rank
+        torch.set_num_threads(n_threads)
+        torch.manual_seed(self.seed * self.n_workers + rank)
+        np.random.seed(self.seed * self.n_workers + rank)
+        self.optimizer = torch.optim.Adam(
+            params, eps=eps, weight_decay=self.weight_decay
+        )
+        self.n_iter = 0
+        while True:
+            command = self._commands[rank].get()
+            if command is None:
+                break
+            try:
+                self.epoch, lr = command
+                for param_group in self.optimizer.param_groups:
+                    param_group["lr"] = lr
+                self.on_epoch_begin()
+                self.reset_running_elbo()
+                super().train_epoch(lr)
+                self._results.put(
+                    (
+                        float(self._running_reconstruction_loss),
+                        float(self._running_kl_divergence),
+                        self._running_n_cells,
+                    )
+                )
+            except Exception:
+                self._results.put(traceback.format_exc())
@@ -1,12 +1,9 @@
 import copy
 
-import matplotlib.pyplot as plt
 import torch
 
 from scvi.inference import Trainer
 
-plt.switch_backend("agg")
-
 
 class UnsupervisedTrainer(Trainer):
     r"""The VariationalInference class for the unsupervised training of an autoencoder.
@@ -53,11 +50,16 @@ class UnsupervisedTrainer(Trainer):
     def posteriors_loop(self):
         return ["train_set"]
 
+    @property
+    def running_elbo_posterior(self):
+        return self.posteriors_loop[0]
+
     def loss(self, tensors):
         sample_batch, local_l_mean, local_l_var, batch_index, _ = tensors
         reconst_loss, kl_divergence = self.model(
             sample_batch, local_l_mean, local_l_var, batch_index
         )
+        self.accumulate_running_elbo(reconst_loss, kl_divergence)
         loss = torch.mean(reconst_loss + self.kl_weight * kl_divergence)
         return loss
 
@@ -83,6 +85,9 @@ class AdapterTrainer(UnsupervisedTrainer):
     def posteriors_loop(self):
         return ["test_set"]
 
+    # the reported elbo of the test set is evaluated at the end of the epochs, not averaged over the losses
+    running_elbo_posterior = None
+
     def train(self, n_path=10, n_epochs=50, **kwargs):
         for i in range(n_path):
             # Re-initialize to create new path
@@ -1,26 +1,17 @@
 import copy
 import os
 import logging
+import queue
+import threading
 
 from typing import List, Optional, Union
 
 import numpy as np
-import pandas as pd
-import scipy
 import torch
 
-from matplotlib import pyplot as plt
-from scipy.stats import kde, entropy
-from sklearn.cluster import KMeans
-from sklearn.manifold import TSNE
-from sklearn.metrics import adjusted_rand_score as ARI
-from sklearn.metrics import normalized_mutual_info_score as NMI
-from sklearn.metrics import silhouette_score
-from sklearn.mixture import GaussianMixture as GMM
-from sklearn.neighbors import NearestNeighbors, KNeighborsRegressor
-from sklearn.utils.linear_assignment_ import linear_assignment
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import (
+    Sampler,
     SequentialSampler,
     SubsetRandomSampler,
     RandomSampler,
@@ -34,12 +25,378 @@ from scvi.models.log_likelihood import (
 
 logger = logging.getLogger(__name__)
 
+# matplotlib, pandas, scipy and sklearn are slow to import: they are imported where they are needed
+_plt = None
+
+
+def get_pyplot():
+    """
+    Imports matplotlib's pyplot on first use, with the non-interactive ``agg`` backend
+    """
+    global _plt
+    if _plt is None:
+        from matplotlib import pyplot as plt
+
+        plt.switch_backend("agg")
+        _plt = plt
+    return _plt
+
 
 class SequentialSubsetSampler(SubsetRandomSampler):
     def __iter__(self):
         return iter(self.indices)
 
 
+class BlockShuffleSampler(SubsetRandomSampler):
+    r"""Samples a subset of cells by shuffling contiguous blocks of rows rather than individual rows.
+
+    The (sorted) indices are cut into blocks of ``block_size`` consecutive rows and the order of the blocks
+    is permuted. Consecutive groups of ``window_size`` blocks are then merged and shuffled row-wise, so that
+    a minibatch only touches a handful of contiguous row ranges. This keeps reads sequential for HDF5, loom
+    or memmap backed data, at the price of less randomness than a `SubsetRandomSampler`.
+
+    :param indices: The indices of the cells to sample from
+    :param block_size: Number of consecutive rows in each block
+    :param window_size: Number of blocks shuffled together. ``1`` only permutes the blocks, while a window
+        covering all the blocks amounts to a full shuffle
+    """
+
+    def __init__(self, indices, block_size=128, window_size=8):
+        if block_size < 1 or window_size < 1:
+            raise ValueError("block_size and window_size should be positive")
+        self.indices = np.sort(indices)
+        self.block_size = block_size
+        self.window_size = window_size
+        self.generator = None
+
+    def __iter__(self):
+        n_blocks = int(np.ceil(len(self.indices) / self.block_size))
+        blocks = torch.randperm(n_blocks, generator=self.generator).numpy()
+        for start in range(0, n_blocks, self.window_size):
+            window = np.concatenate(
+                [
+                    self.indices[b * self.block_size : (b + 1) * self.block_size]
+                    for b in blocks[start : start + self.window_size]
+                ]
+            )
+            yield from window[
+                torch.randperm(len(window), generator=self.generator).numpy()
+            ]
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def group_ranks(groups):
+    r"""Rank of each element among the elements of the same group, in order of appearance.
+
+    :param groups: Non-negative integer group of each element
+    :return: The ranks, and the size of each group
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    counts = np.bincount(groups)
+    order = np.argsort(groups, kind="stable")
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - (np.cumsum(counts) - counts)[groups[order]]
+    return ranks, counts
+
+
+class StratifiedSampler(SubsetRandomSampler):
+    r"""Samples a subset of cells in an order that keeps the proportions of every (label, batch) stratum.
+
+    The cells of each stratum are shuffled and spread evenly over the epoch, so that any run of consecutive
+    cells, and hence every minibatch, holds each stratum in proportion to its size, within a couple of cells.
+    Every cell is sampled exactly once per epoch.
+
+    :param indices: The indices of the cells to sample from
+    :param labels: Label of each cell of the dataset
+    :param batch_indices: Batch of each cell of the dataset. Default: ``None`` (stratify on labels only)
+    """
+
+    def __init__(self, indices, labels, batch_indices=None):
+        self.indices = np.asarray(indices)
+        keys = [np.asarray(labels).ravel()[self.indices]]
+        if batch_indices is not None:
+            keys.append(np.asarray(batch_indices).ravel()[self.indices])
+        self.strata = np.unique(np.stack(keys), axis=1, return_inverse=True)[1]
+        self.generator = None
+
+    def __iter__(self):
+        permutation = torch.randperm(
+            len(self.indices), generator=self.generator
+        ).numpy()
+        strata = self.strata[permutation]
+        ranks, counts = group_ranks(strata)
+        offsets = torch.rand(len(counts), generator=self.generator).numpy()
+        positions = (ranks + offsets[strata]) / counts[strata]
+        return iter(self.indices[permutation[np.argsort(positions, kind="stable")]])
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class NonzeroBalancedBatchSampler(Sampler):
+    r"""Groups cells into minibatches holding a roughly constant number of nonzero entries.
+
+    Every cell of ``indices`` is yielded exactly once per epoch. Cells are visited in random (or sorted) order
+    and a new batch is started every ``max_nnz`` nonzero entries, so that batches of sparse cells contain more
+    cells than batches of dense ones. As the batch sizes vary, ``mean_batch_size`` gives the expected number
+    of cells per batch, which trainers use to weight the per-batch losses.
+
+    :param indices: The indices of the cells to sample from
+    :param nnz: Number of nonzero entries of each cell of the dataset
+    :param batch_size: Number of cells of an average batch, used to set ``max_nnz`` if not specified
+    :param max_nnz: Number of nonzero entries per batch
+    :param shuffle: Whether to visit the cells in random order
+    """
+
+    def __init__(self, indices, nnz, batch_size=128, max_nnz=None, shuffle=True):
+        self.indices = np.sort(indices)
+        self.nnz = np.asarray(nnz)[self.indices].astype(np.int64)
+        total_nnz = max(self.nnz.sum(), 1)
+        if max_nnz is None:
+            max_nnz = batch_size * total_nnz / len(self.indices)
+        # a single cell should always fit in a batch
+        self.max_nnz = max(max_nnz, self.nnz.max(initial=1))
+        self.mean_batch_size = len(self.indices) * self.max_nnz / total_nnz
+        self.shuffle = shuffle
+        self.generator = None
+        self._batches = None
+
+    def plan(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.indices), generator=self.generator).numpy()
+        else:
+            order = np.arange(len(self.indices))
+        starts = np.cumsum(self.nnz[order]) - self.nnz[order]
+        batch_ids = (starts // self.max_nnz).astype(np.int64)
+        splits = np.flatnonzero(np.diff(batch_ids)) + 1
+        return np.split(self.indices[order], splits)
+
+    def __iter__(self):
+        batches = self._batches if self._batches is not None else self.plan()
+        self._batches = None
+        return iter(batches)
+
+    def __len__(self):
+        # the number of batches depends on the order, so plan the next epoch now
+        if self._batches is None:
+            self._batches = self.plan()
+        return len(self._batches)
+
+
+class SpatialBlockSampler(Sampler):
+    r"""Yields minibatches of spatially close cells.
+
+    The cells are sorted along a space-filling curve of the dataset's spatial grid and cut into
+    consecutive batches of ``batch_size`` cells, whose order is shuffled at every epoch.
+
+    :param indices: The indices of the cells to sample from
+    :param spatial_index: The ``SpatialGrid`` of the dataset
+    :param batch_size: Number of cells per batch
+    :param shuffle: Whether to shuffle the order of the batches
+    """
+
+    def __init__(self, indices, spatial_index, batch_size=128, shuffle=True):
+        indices = np.asarray(indices)
+        keys = spatial_index.locality_keys[indices]
+        self.indices = indices[np.argsort(keys, kind="stable")]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = None
+
+    def __iter__(self):
+        n_batches = len(self)
+        order = (
+            torch.randperm(n_batches, generator=self.generator)
+            if self.shuffle
+            else range(n_batches)
+        )
+        for i in order:
+            yield self.indices[i * self.batch_size : (i + 1) * self.batch_size]
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+
+class ShardedSampler(Sampler):
+    r"""Samples the shard of a subset of cells assigned to one of several processes.
+
+    Every process draws the same permutation of the indices, seeded by ``seed``, and keeps every
+    ``num_replicas``-th cell of it starting at ``rank``, so that the shards are disjoint. The permutation is
+    padded by wrapping around so that all the shards have the same length, and the processes run the same
+    number of minibatches.
+
+    :param indices: The indices of the cells to sample from
+    :param num_replicas: Number of processes
+    :param rank: Rank of this process
+    :param shuffle: Whether to permute the indices
+    :param seed: Seed of the permutation, to be changed at every epoch
+    """
+
+    def __init__(self, indices, num_replicas, rank, shuffle=True, seed=0):
+        self.indices = np.asarray(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed)
+            indices = self.indices[
+                torch.randperm(len(self.indices), generator=generator).numpy()
+            ]
+        else:
+            indices = self.indices
+        indices = np.resize(indices, len(self) * self.num_replicas)
+        return iter(indices[self.rank :: self.num_replicas])
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.num_replicas))
+
+
+class MultiStreamLoader:
+    r"""Iterates over several posteriors at once, yielding one list of tensors per posterior at each step.
+
+    The first posterior drives the loop: an iteration runs one step per minibatch of it. The other streams are
+    interleaved according to ``ratios``, and their iterators are re-created when they are exhausted, so that
+    their cells are reshuffled and no minibatch is kept beyond the last one drawn.
+
+    :param posteriors: The posteriors to iterate over
+    :param ratios: Relative rates at which the streams draw new minibatches, e.g. ``[2, 1]`` draws a new
+        minibatch of the second posterior every two minibatches of the first, and reuses the last one in between.
+        A stream drawing several minibatches in one step concatenates them. Default: ``None``, all the streams
+        draw one minibatch per step.
+    :param batch_sizes: Batch size of each stream, or ``None`` to keep the one of its posterior, which is the only
+        choice for the posteriors with a ``batch_sampler``, e.g. ``nonzero_balanced``. Default: ``None``.
+    :param n_prefetch: Number of steps assembled ahead of time by a background thread. Default: ``0``, the
+        minibatches are loaded on demand.
+    """
+
+    def __init__(self, posteriors, ratios=None, batch_sizes=None, n_prefetch=0):
+        if ratios is not None and len(ratios) != len(posteriors):
+            raise ValueError("ratios should have one value per posterior")
+        if batch_sizes is not None and len(batch_sizes) != len(posteriors):
+            raise ValueError("batch_sizes should have one value per posterior")
+        for posterior, batch_size in zip(posteriors, batch_sizes or []):
+            if (
+                batch_size is not None
+                and "batch_sampler" in posterior.data_loader_kwargs
+            ):
+                raise ValueError(
+                    "the batch size of a posterior with a batch_sampler is set by its sampler"
+                )
+        self.posteriors = [
+            posterior.update({"batch_size": batch_size})
+            if batch_size is not None
+            else posterior
+            for posterior, batch_size in zip(
+                posteriors, batch_sizes or [None] * len(posteriors)
+            )
+        ]
+        ratios = ratios or [1] * len(posteriors)
+        self.rates = [ratio / ratios[0] for ratio in ratios]
+        self.n_prefetch = n_prefetch
+
+    def __len__(self):
+        return len(self.posteriors[0].data_loader)
+
+    def __iter__(self):
+        if self.n_prefetch > 0:
+            # the background thread shuffles the streams with generators seeded here, on the main thread, so
+            # that it does not draw from the random stream of the training running concurrently
+            posteriors = [self.seeded(posterior) for posterior in self.posteriors]
+            return self._prefetched(self._steps(posteriors))
+        return self._steps(self.posteriors)
+
+    @staticmethod
+    def seeded(posterior):
+        r"""A copy of ``posterior`` whose DataLoader and sampler draw their random numbers from a new generator,
+        seeded by the global one. The sampler is shared with ``posterior``, and keeps the generator."""
+        generator = torch.Generator()
+        generator.manual_seed(int(torch.randint(2 ** 62, (1,))))
+        loader_kwargs = posterior.data_loader_kwargs
+        sampler = loader_kwargs.get("batch_sampler", loader_kwargs.get("sampler"))
+        if sampler is not None:
+            sampler.generator = generator
+        # the generator of the DataLoader seeds its iterators
+        return posterior.update({"generator": generator})
+
+    def _steps(self, posteriors):
+        iterators = [None] * len(posteriors)
+        # the first step draws one minibatch of every stream
+        credits = [max(rate, 1.0) for rate in self.rates]
+        last = [None] * len(posteriors)
+        for tensors in posteriors[0]:
+            step = [tensors]
+            for i in range(1, len(posteriors)):
+                n_draws = int(credits[i] + 1e-9)
+                credits[i] += self.rates[i] - n_draws
+                if n_draws:
+                    minibatches = []
+                    for _ in range(n_draws):
+                        minibatch, iterators[i] = self._draw(
+                            posteriors[i], iterators[i]
+                        )
+                        minibatches.append(minibatch)
+                    last[i] = (
+                        minibatches[0]
+                        if n_draws == 1
+                        else [torch.cat(columns) for columns in zip(*minibatches)]
+                    )
+                step.append(last[i])
+            yield step
+
+    @staticmethod
+    def _draw(posterior, iterator):
+        if iterator is not None:
+            try:
+                return next(iterator), iterator
+            except StopIteration:
+                pass
+        iterator = iter(posterior)
+        return next(iterator), iterator
+
+    def _prefetched(self, steps):
+        steps_queue = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    steps_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for step in steps:
+                    if not put(("step", step)):
+                        return
+                put(("end", None))
+            except Exception as error:
+                put(("error", error))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                kind, item = steps_queue.get()
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise item
+                yield item
+        finally:
+            # also stops the thread when the loop is left early
+            stop.set()
+            thread.join()
+
+
 class Posterior:
     r"""The functional data unit. A `Posterior` instance is instantiated with a model and a gene_dataset, and
     as well as additional arguments that for Pytorch's `DataLoader`. A subset of indices can be specified, for
@@ -119,7 +476,9 @@ class Posterior:
 
     @property
     def indices(self):
-        if hasattr(self.data_loader.sampler, "indices"):
+        if hasattr(self.data_loader.batch_sampler, "indices"):
+            return self.data_loader.batch_sampler.indices
+        elif hasattr(self.data_loader.sampler, "indices"):
             return self.data_loader.sampler.indices
         else:
             return np.arange(len(self.gene_dataset))
@@ -133,10 +492,18 @@ class Posterior:
     def update(self, data_loader_kwargs):
         posterior = copy.copy(self)
         posterior.data_loader_kwargs = copy.copy(self.data_loader_kwargs)
+        if "sampler" in data_loader_kwargs:
+            posterior.data_loader_kwargs.pop("batch_sampler", None)
         posterior.data_loader_kwargs.update(data_loader_kwargs)
-        posterior.data_loader = DataLoader(
-            self.gene_dataset, **posterior.data_loader_kwargs
-        )
+        loader_kwargs = posterior.data_loader_kwargs
+        if "batch_sampler" in loader_kwargs:
+            # batch_sampler is mutually exclusive with batch_size and sampler
+            loader_kwargs = {
+                key: value
+                for key, value in loader_kwargs.items()
+                if key not in ["batch_size", "sampler"]
+            }
+        posterior.data_loader = DataLoader(self.gene_dataset, **loader_kwargs)
         return posterior
 
     def sequential(self, batch_size=128):
@@ -147,6 +514,60 @@ class Posterior:
             }
         )
 
+    def block_shuffle(self, block_size=128, window_size=8):
+        return self.update(
+            {
+                "sampler": BlockShuffleSampler(
+                    self.indices, block_size=block_size, window_size=window_size
+                )
+            }
+        )
+
+    def spatially_blocked(self, batch_size=128, shuffle=True):
+        return self.update(
+            {
+                "batch_sampler": SpatialBlockSampler(
+                    self.indices,
+                    self.gene_dataset.spatial_index,
+                    batch_size=batch_size,
+                    shuffle=shuffle,
+                )
+            }
+        )
+
+    def stratified(self, by_batch=True):
+        batch_indices = self.gene_dataset.batch_indices if by_batch else None
+        return self.update(
+            {
+                "sampler": StratifiedSampler(
+                    self.indices, self.gene_dataset.labels, batch_indices
+                )
+            }
+        )
+
+    def sharded(self, num_replicas, rank, shuffle=True, seed=0):
+        return self.update(
+            {
+                "sampler": ShardedSampler(
+                    self.indices, num_replicas, rank, shuffle=shuffle, seed=seed
+                )
+            }
+        )
+
+    def nonzero_balanced(self, batch_size=128, max_nnz=None, shuffle=True):
+        nnz = np.asarray((self.gene_dataset.X != 0).sum(axis=1)).ravel()
+        return self.update(
+            {
+                "batch_sampler": NonzeroBalancedBatchSampler(
+                    self.indices,
+                    nnz,
+                    batch_size=batch_size,
+                    max_nnz=max_nnz,
+                    shuffle=shuffle,
+                )
+            }
+        )
+
     def corrupted(self):
         return self.update({"collate_fn": self.gene_dataset.collate_fn_corrupted})
 
@@ -382,6 +803,8 @@ class Posterior:
             mean1, mean2, nonz1, nonz2, norm_mean1, norm_mean2 = self.gene_dataset.raw_counts_properties(
                 idx1, idx2
             )
+            import pandas as pd
+
             res = pd.DataFrame(
                 [
                     bayes1,
@@ -499,6 +922,8 @@ class Posterior:
                 res["clusters"] = np.repeat(x, len(res.index))
                 de_res.append(res)
         if output_file:  # store as an excel spreadsheet
+            import pandas as pd
+
             writer = pd.ExcelWriter(
                 save_dir + "differential_expression.%s.xlsx" % filename,
                 engine="xlsxwriter",
@@ -599,6 +1024,8 @@ class Posterior:
                 res["clusters"] = np.repeat(x, len(res.index))
                 de_res.append(res)
         if output_file:  # store as an excel spreadsheet
+            import pandas as pd
+
             writer = pd.ExcelWriter(
                 save_dir + "differential_expression.%s.xlsx" % filename,
                 engine="xlsxwriter",
@@ -620,6 +1047,115 @@ class Posterior:
         imputed_list = np.concatenate(imputed_list)
         return imputed_list.squeeze()
 
+    @torch.no_grad()
+    def write_outputs(self, out, compute, batch_size=128):
+        """
+        Writes the output of each cell in place into the row of ``out`` corresponding to its index in the dataset,
+        batch by batch, without concatenating the batches.
+        :param out: array-like supporting slice assignment (``np.ndarray``, ``np.memmap``, ``h5py.Dataset``),
+            with a row per cell of the dataset
+        :param compute: function mapping the tensors of a batch to the tensor of its outputs
+        :param batch_size: number of cells per batch
+        :return: ``out``
+        """
+        # in increasing order of index, so that each batch is written in a few contiguous slices
+        indices = np.sort(self.indices)
+        posterior = self.update(
+            {"batch_size": batch_size, "sampler": SequentialSubsetSampler(indices)}
+        )
+        start = 0
+        for tensors in posterior:
+            values = compute(tensors).cpu().numpy()
+            rows = indices[start : start + len(values)]
+            start += len(values)
+            # write each run of consecutive cells as a slice, which every storage supports efficiently
+            runs = np.split(
+                np.arange(len(rows)), np.flatnonzero(np.diff(rows) != 1) + 1
+            )
+            for run in runs:
+                out[rows[run[0]] : rows[run[-1]] + 1] = values[run[0] : run[-1] + 1]
+        return out
+
+    def write_latent(self, out, sample=False, batch_size=128):
+        """
+        Writes the posterior z mean (or sample) of the cells into ``out``, see ``write_outputs``
+        """
+        return self.write_outputs(
+            out,
+            lambda tensors: self.model.sample_from_posterior_z(
+                tensors[0], give_mean=not sample
+            ),
+            batch_size=batch_size,
+        )
+
+    def write_imputation(self, out, n_samples=1, batch_size=128):
+        """
+        Writes the imputed expression of the cells, averaged over ``n_samples``, into ``out``, see ``write_outputs``
+        """
+
+        def compute(tensors):
+            sample_batch, _, _, batch_index, labels = tensors[:5]
+            px_rate = self.model.get_sample_rate(
+                sample_batch, batch_index=batch_index, y=labels, n_samples=n_samples
+            )
+            return px_rate.mean(dim=0) if n_samples > 1 else px_rate
+
+        return self.write_outputs(out, compute, batch_size=batch_size)
+
+    def write_predictions(self, out, soft=False, batch_size=128):
+        """
+        Writes the predicted labels (or, if ``soft``, the labels' probabilities) of the cells into ``out``,
+        see ``write_outputs``
+        """
+
+        def compute(tensors):
+            probas = self.model.classify(tensors[0])
+            return probas if soft else probas.argmax(dim=-1)
+
+        return self.write_outputs(out, compute, batch_size=batch_size)
+
+    def export_to_anndata(
+        self,
+        adata,
+        latent_key="X_scvi",
+        imputed_layer=None,
+        predictions_key=None,
+        sample=False,
+        n_samples=1,
+        batch_size=128,
+    ):
+        """
+        Writes the latent space and imputed values of the cells directly into storage owned by ``adata`` (whose
+        observations are the cells of the dataset, in the same order), and assigns their predicted labels to
+        ``adata.obs``. Rows of cells outside of the posterior are left to zero. For backed AnnData objects, pass
+        their HDF5 datasets to the ``write_*`` methods instead.
+        :param adata: an ``AnnData`` object
+        :param latent_key: key of ``adata.obsm`` receiving the latent space, or ``None``
+        :param imputed_layer: name of the layer receiving the imputed values, or ``None``
+        :param predictions_key: column of ``adata.obs`` receiving the predicted labels, or ``None``
+        :return: ``adata``
+        """
+        n_cells = len(self.gene_dataset)
+        if adata.n_obs != n_cells:
+            raise ValueError(
+                "adata has %d observations but the dataset has %d cells"
+                % (adata.n_obs, n_cells)
+            )
+        if latent_key is not None:
+            n_latent = self.model.n_latent
+            adata.obsm[latent_key] = np.zeros((n_cells, n_latent), dtype=np.float32)
+            self.write_latent(adata.obsm[latent_key], sample, batch_size)
+        if imputed_layer is not None:
+            n_genes = self.gene_dataset.nb_genes
+            adata.layers[imputed_layer] = np.zeros((n_cells, n_genes), dtype=np.float32)
+            self.write_imputation(adata.layers[imputed_layer], n_samples, batch_size)
+        if predictions_key is not None:
+            # the values of a column of adata.obs may be a copy, or read-only under Copy-on-Write
+            predictions = np.zeros(n_cells, dtype=np.int64)
+            self.write_predictions(predictions, batch_size=batch_size)
+            adata.obs[predictions_key] = predictions
+        return adata
+
     @torch.no_grad()
     def generate(
         self, n_samples=100, genes=None
@@ -832,6 +1368,12 @@ class Posterior:
 
     @torch.no_grad()
     def clustering_scores(self, prediction_algorithm="knn"):
+        from sklearn.cluster import KMeans
+        from sklearn.metrics import adjusted_rand_score as ARI
+        from sklearn.metrics import normalized_mutual_info_score as NMI
+        from sklearn.metrics import silhouette_score
+        from sklearn.mixture import GaussianMixture as GMM
+
         if self.gene_dataset.n_labels > 1:
             latent, _, labels = self.get_latent()
             if prediction_algorithm == "knn":
@@ -885,6 +1427,7 @@ class Posterior:
         labels=None,
         n_batch=None,
     ):
+        plt = get_pyplot()
         # If no latent representation is given
         if latent is None:
             latent, batch_indices, labels = self.get_latent(sample=True)
@@ -949,6 +1492,8 @@ class Posterior:
 
     @staticmethod
     def apply_t_sne(latent, n_samples=1000):
+        from sklearn.manifold import TSNE
+
         idx_t_sne = (
             np.random.permutation(len(latent))[:n_samples]
             if n_samples
@@ -969,6 +1514,8 @@ class Posterior:
 
 
 def entropy_from_indices(indices):
+    from scipy.stats import entropy
+
     return entropy(np.array(np.unique(indices, return_counts=True)[1].astype(np.int32)))
 
 
@@ -984,12 +1531,13 @@ def entropy_batch_mixing(
             return 0
         return -frequency * np.log(frequency) - (1 - frequency) * np.log(1 - frequency)
 
+    from scipy.sparse import identity
+    from sklearn.neighbors import NearestNeighbors
+
     n_neighbors = min(n_neighbors, len(latent_space) - 1)
     nne = NearestNeighbors(n_neighbors=1 + n_neighbors, n_jobs=8)
     nne.fit(latent_space)
-    kmatrix = nne.kneighbors_graph(latent_space) - scipy.sparse.identity(
-        latent_space.shape[0]
-    )
+    kmatrix = nne.kneighbors_graph(latent_space) - identity(latent_space.shape[0])
 
     score = 0
     for t in range(n_pools):
@@ -1082,6 +1630,9 @@ def get_bayes_factors(
 
 
 def plot_imputation(original, imputed, show_plot=True, title="Imputation"):
+    from scipy.stats import kde
+
+    plt = get_pyplot()
     y = imputed
     x = original
 
@@ -1135,19 +1686,21 @@ def nn_overlap(X1, X2, k=100):
     Compute the overlap between the k-nearest neighbor graph of X1 and X2 using Spearman correlation of the
     adjacency matrices.
     """
+    from scipy.sparse import identity
+    from scipy.stats import spearmanr
+    from sklearn.neighbors import NearestNeighbors
+
     assert len(X1) == len(X2)
     n_samples = len(X1)
     k = min(k, n_samples - 1)
     nne = NearestNeighbors(n_neighbors=k + 1)  # "n_jobs=8
     nne.fit(X1)
-    kmatrix_1 = nne.kneighbors_graph(X1) - scipy.sparse.identity(n_samples)
+    kmatrix_1 = nne.kneighbors_graph(X1) - identity(n_samples)
     nne.fit(X2)
-    kmatrix_2 = nne.kneighbors_graph(X2) - scipy.sparse.identity(n_samples)
+    kmatrix_2 = nne.kneighbors_graph(X2) - identity(n_samples)
 
     # 1 - spearman correlation from knn graphs
-    spearman_correlation = scipy.stats.spearmanr(
-        kmatrix_1.A.flatten(), kmatrix_2.A.flatten()
-    )[0]
+    spearman_correlation = spearmanr(kmatrix_1.A.flatten(), kmatrix_2.A.flatten())[0]
     # 2 - fold enrichment
     set_1 = set(np.where(kmatrix_1.A.flatten() == 1)[0])
     set_2 = set(np.where(kmatrix_2.A.flatten() == 1)[0])
@@ -1163,6 +1716,8 @@ def unsupervised_clustering_accuracy(y, y_pred):
     """
     Unsupervised Clustering Accuracy
     """
+    from sklearn.utils.linear_assignment_ import linear_assignment
+
     assert len(y_pred) == len(y)
     u = np.unique(np.concatenate((y, y_pred)))
     n_clusters = len(u)
@@ -1177,6 +1732,8 @@ def unsupervised_clustering_accuracy(y, y_pred):
 
 
 def knn_purity(latent, label, n_neighbors=30):
+    from sklearn.neighbors import NearestNeighbors
+
     nbrs = NearestNeighbors(n_neighbors=n_neighbors + 1).fit(latent)
     indices = nbrs.kneighbors(latent, return_distance=False)[:, 1:]
     neighbors_labels = np.vectorize(lambda i: label[i])(indices)
@@ -1191,6 +1748,8 @@ def knn_purity(latent, label, n_neighbors=30):
 
 
 def proximity_imputation(real_latent1, normed_gene_exp_1, real_latent2, k=4):
+    from sklearn.neighbors import KNeighborsRegressor
+
     knn = KNeighborsRegressor(k, weights="distance")
     y = knn.fit(real_latent1, normed_gene_exp_1).predict(real_latent2)
     return y
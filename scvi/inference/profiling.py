@@ -0,0 +1,121 @@
+"""Instrumentation of the phases of the training loop."""
+import contextlib
+import sys
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    r"""Peak resident set size of the process so far, in MB, or ``None`` where it is not available."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+class PhaseProfiler:
+    r"""Wall time of the phases of the training loop, accumulated over an epoch.
+
+    The phases of ``Trainer`` are ``'data'``, ``'forward'``, ``'backward'``, ``'step'`` and ``'metrics'``. Each
+    phase also runs the context managers returned by the attached hooks, so that callers can time them with
+    their own tools.
+
+    Args:
+        :synchronize: If True, CUDA is synchronized at the end of each phase so that asynchronous kernels are
+            timed in the phase that launched them. Default: ``False``.
+
+    Examples:
+        >>> profiler = PhaseProfiler()
+        >>> with profiler.phase("forward"):
+        ...     loss = trainer.loss(tensors)
+        >>> profiler.end_epoch()
+    """
+    phases = ["data", "forward", "backward", "step", "metrics"]
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.hooks = []
+        self.record_functions = False
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.n_batches = 0
+        self.n_cells = 0
+        self._begin = time.perf_counter()
+
+    def add_hook(self, hook):
+        r"""Attaches ``hook``, a callable taking the name of a phase and returning a context manager."""
+        self.hooks.append(hook)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with contextlib.ExitStack() as stack:
+            for hook in self.hooks:
+                stack.enter_context(hook(name))
+            if self.record_functions:
+                stack.enter_context(torch.profiler.record_function(name))
+            begin = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.synchronize:
+                    torch.cuda.synchronize()
+                self.times[name] = (
+                    self.times.get(name, 0.0) + time.perf_counter() - begin
+                )
+
+    def iterate(self, iterable, name="data"):
+        r"""Iterates over ``iterable``, timing the production of each item as the phase ``name``."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, n_cells):
+        r"""Counts a minibatch of ``n_cells`` cells in the throughput of the epoch."""
+        self.n_batches += 1
+        self.n_cells += n_cells
+
+    @contextlib.contextmanager
+    def trace(self, path, use_cuda=False):
+        r"""Profiles its body with ``torch.profiler`` and writes the Chrome trace to ``path``, in which the
+        phases appear as labelled ranges."""
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if use_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.record_functions = True
+        try:
+            with torch.profiler.profile(activities=activities) as profile:
+                yield
+        finally:
+            self.record_functions = False
+        profile.export_chrome_trace(path)
+
+    def end_epoch(self):
+        r"""Returns the statistics of the epoch and starts a new one.
+
+        :return: a dict with the time of each phase in seconds (``'time_<phase>'``), the time of the epoch, the
+            number of minibatches and cells per second of training, excluding the ``'metrics'`` phase, and the
+            peak resident set size of the process so far in MB
+        """
+        elapsed = time.perf_counter() - self._begin
+        statistics = {"time_" + name: value for name, value in self.times.items()}
+        statistics["time_epoch"] = elapsed
+        training_time = max(elapsed - self.times["metrics"], 1e-12)
+        statistics["batches_per_second"] = self.n_batches / training_time
+        statistics["cells_per_second"] = self.n_cells / training_time
+        statistics["peak_rss_mb"] = peak_rss()
+        self.reset()
+        return statistics
@@ -1,22 +1,31 @@
+import contextlib
+import copy
+import inspect
+import itertools
 import logging
+import os
+import random
 import sys
 import time
 
 from abc import abstractmethod
 from collections import defaultdict, OrderedDict
-from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 
-from sklearn.model_selection._split import _validate_shuffle_split
 from torch.utils.data.sampler import SubsetRandomSampler
-from tqdm import trange
 
-from scvi.inference.posterior import Posterior
+from scvi.inference.posterior import MultiStreamLoader, Posterior
+from scvi.inference.profiling import PhaseProfiler
+from scvi.models.modules import Encoder
 
 logger = logging.getLogger(__name__)
 
+# entered by the phases of the training loop when they are not profiled
+_no_phase = contextlib.nullcontext()
+
 
 class Trainer:
     r"""The abstract Trainer class for training a PyTorch model and monitoring its statistics. It should be
@@ -36,8 +45,53 @@ class Trainer:
         :on: The data_loader name reference for the ``early_stopping_metric`` and ``save_best_state_metric``, that
             should be specified if any of them is. Default: ``None``.
         :show_progbar: If False, disables progress bar.
+        :mixed_precision: If True, the loss and the monitored metrics are computed under bfloat16 autocast. The
+            likelihoods and the KL divergences are still computed in float32. Default: ``False``.
+        :accumulation_steps: Number of minibatches whose gradients are accumulated before each optimizer step,
+            so that the effective batch size is ``accumulation_steps`` times the minibatch size. Default: ``1``.
+        :lr_scaling: How the learning rate of ``train`` scales with the effective batch size relative to
+            ``base_batch_size``: ``'linear'``, ``'sqrt'`` or ``None`` for no scaling. Default: ``None``.
+        :base_batch_size: The batch size the learning rate of ``train`` is tuned for. Default: ``128``.
+        :lr_warmup_epochs: Number of epochs over which the learning rate is linearly increased up to its
+            (scaled) value at the beginning of ``train``. Default: ``0``.
+        :lr_schedule: Schedule of the learning rate over the optimizer steps of ``train``, after the warmup:
+            ``'cosine'`` anneals it to 0, ``'one_cycle'`` raises it from ``lr / 25`` to ``lr`` over the first 30%
+            of the steps and anneals it to ``lr / 25e4``, and ``None`` keeps it constant. The learning rate
+            reductions of the early stopping are overridden by the schedules. Default: ``None``.
+        :checkpoint_path: Where to write training checkpoints, which ``train(resume_from=...)`` continues from.
+            It may contain an ``{epoch}`` field to keep one file per checkpoint. Default: ``None`` (no checkpoints).
+        :checkpoint_frequency: Number of epochs between two checkpoints. Default: ``1``.
+        :best_state_path: Optional file where the weights achieving the best ``save_best_state_metric`` are kept,
+            as a memory map, instead of in memory. Default: ``None``.
+        :n_eval_workers: Number of threads evaluating the monitored (posterior, metric) pairs concurrently in
+            ``compute_metrics``, sharing the intra-op threads of torch. Default: ``1`` (sequential evaluation).
+        :async_metrics: If True, the metrics of an epoch are computed on a background thread, on a copy of the
+            model holding the weights of that epoch, while training goes on. Early stopping and
+            ``save_best_state_metric`` then act on results at most one evaluation interval old. Default: ``False``.
+        :stream_ratios: Relative rates at which the posteriors of ``posteriors_loop`` draw new minibatches in the
+            training loop, see ``MultiStreamLoader``. Default: ``None``, one minibatch of each per step.
+        :stream_batch_sizes: Batch size of each posterior of ``posteriors_loop`` in the training loop, or ``None``
+            to keep its own. Default: ``None``.
+        :n_prefetch: Number of steps of the training loop loaded ahead of time by a background thread.
+            Default: ``0``.
+        :compile_model: If True, the model is compiled in place with ``torch.nn.Module.compile`` when it is
+            available (torch >= 2.2). On older versions, only the likelihoods of the reconstruction loss are
+            compiled with TorchScript, which leaves the overhead of the encoders and decoders untouched.
+            Default: ``False``.
+        :profile: If True, the wall time of the phases of each epoch (``'data'``, ``'forward'``, ``'backward'``,
+            ``'step'`` and ``'metrics'``), the minibatches and cells per second and the peak resident set size of
+            the process are recorded in ``history``, under the keys returned by ``PhaseProfiler.end_epoch``.
+            Default: ``False``.
+        :trace_epochs: Epochs profiled with ``torch.profiler``, whose Chrome traces are written to ``trace_path``.
+            Default: ``None``.
+        :trace_path: Where to write the Chrome traces of ``trace_epochs``, with an ``{epoch}`` field.
+            Default: ``'trace_{epoch}.json'``.
     """
     default_metrics_to_monitor = []
+    # the values of stop_reason, to be extended by subclasses adding their own
+    stop_reasons = ["n_epochs", "early_stopping", "target", "max_time"]
+    # name of the posterior whose elbo is accumulated from the training losses rather than evaluated
+    running_elbo_posterior = None
 
     def __init__(
         self,
@@ -51,6 +105,24 @@ class Trainer:
         early_stopping_kwargs=None,
         data_loader_kwargs=None,
         show_progbar=True,
+        mixed_precision=False,
+        accumulation_steps=1,
+        lr_scaling=None,
+        base_batch_size=128,
+        lr_warmup_epochs=0,
+        lr_schedule=None,
+        checkpoint_path=None,
+        checkpoint_frequency=1,
+        best_state_path=None,
+        n_eval_workers=1,
+        async_metrics=False,
+        stream_ratios=None,
+        stream_batch_sizes=None,
+        n_prefetch=0,
+        compile_model=False,
+        profile=False,
+        trace_epochs=None,
+        trace_path="trace_{epoch}.json",
     ):
         # handle mutable defaults
         early_stopping_kwargs = (
@@ -88,85 +160,642 @@ class Trainer:
 
         self.history = defaultdict(list)
 
-        self.best_state_dict = self.model.state_dict()
+        self.best_state = None
+        if self.early_stopping.save_best_state_metric is not None:
+            self.best_state = StateSnapshot(self.model, path=best_state_path)
+            self.best_state.update(self.model)
         self.best_epoch = self.epoch
 
         self.show_progbar = show_progbar
 
+        if mixed_precision and not hasattr(torch, "autocast"):
+            raise ValueError("mixed_precision requires torch.autocast (torch >= 1.10)")
+        self.mixed_precision = mixed_precision
+
+        if lr_scaling not in [None, "linear", "sqrt"]:
+            raise ValueError("lr_scaling should be one of None, 'linear' or 'sqrt'")
+        self.accumulation_steps = accumulation_steps
+        self.lr_scaling = lr_scaling
+        self.base_batch_size = base_batch_size
+        self.lr_warmup_epochs = lr_warmup_epochs
+        if lr_schedule not in [None, "cosine", "one_cycle"]:
+            raise ValueError(
+                "lr_schedule should be one of None, 'cosine' or 'one_cycle'"
+            )
+        self.lr_schedule = lr_schedule
+        self.n_iter = 0
+        self.n_iter_total = 0
+
+        self.max_time = None
+        self.target = None
+        self.stop_reason = None
+
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_frequency = checkpoint_frequency
+        self._checkpoint_executor = None
+        self._checkpoint_future = None
+
+        self.reset_running_elbo()
+        self.n_eval_workers = n_eval_workers
+
+        self.async_metrics = async_metrics
+        self._shadow_model = None
+        self._shadow_epoch = None
+        self._metrics_executor = None
+        self._pending_metrics = None
+
+        self.stream_ratios = stream_ratios
+        self.stream_batch_sizes = stream_batch_sizes
+        self.n_prefetch = n_prefetch
+
+        self.compile_model = compile_model
+        if compile_model:
+            if hasattr(self.model, "compile"):
+                # the forward pass is compiled, while loss keeps updating the running statistics eagerly
+                self.model.compile()
+            else:
+                self.model.script_likelihoods = True
+
+        if trace_epochs and not hasattr(torch, "profiler"):
+            raise ValueError("trace_epochs requires torch.profiler (torch >= 1.8.1)")
+        self.profile = profile
+        self.trace_epochs = set(trace_epochs) if trace_epochs else set()
+        self.trace_path = trace_path
+        self.profiler = None
+        if profile or self.trace_epochs:
+            self.profiler = PhaseProfiler(synchronize=self.use_cuda)
+
+    @property
+    def best_state_dict(self):
+        if self.best_state is None:
+            return self.model.state_dict()
+        return self.best_state.state_dict()
+
+    @property
+    def effective_batch_size(self):
+        return self.data_loader_kwargs["batch_size"] * self.accumulation_steps
+
+    def scale_lr(self, lr):
+        ratio = self.effective_batch_size / self.base_batch_size
+        if self.lr_scaling == "linear":
+            return lr * ratio
+        if self.lr_scaling == "sqrt":
+            return lr * np.sqrt(ratio)
+        return lr
+
+    def autocast(self):
+        r"""Context manager running its body under bfloat16 autocast if ``mixed_precision`` is set."""
+        if not self.mixed_precision:
+            return contextlib.nullcontext()
+        return torch.autocast("cuda" if self.use_cuda else "cpu", dtype=torch.bfloat16)
+
+    def phase(self, name):
+        r"""Context manager timing its body as the phase ``name`` of the epoch, if the training is profiled."""
+        if self.profiler is None:
+            return _no_phase
+        return self.profiler.phase(name)
+
+    def add_phase_hook(self, hook):
+        r"""Attaches ``hook`` to the phases of the training loop: it is called with the name of each phase and
+        returns a context manager entered around it, e.g. the timer of the caller."""
+        if self.profiler is None:
+            self.profiler = PhaseProfiler(synchronize=self.use_cuda)
+        self.profiler.add_hook(hook)
+
+    def trace(self, epoch):
+        r"""Context manager profiling its body with ``torch.profiler`` if ``epoch`` is one of ``trace_epochs``."""
+        if epoch not in self.trace_epochs:
+            return contextlib.nullcontext()
+        return self.profiler.trace(
+            self.trace_path.format(epoch=epoch), use_cuda=self.use_cuda
+        )
+
+    def is_metrics_epoch(self, epoch):
+        return bool(self.frequency) and (
+            epoch == 0 or epoch == self.n_epochs or (epoch % self.frequency == 0)
+        )
+
+    def is_checkpoint_epoch(self, epoch):
+        return (
+            self.checkpoint_path is not None
+            and (epoch + 1) % self.checkpoint_frequency == 0
+        )
+
     @torch.no_grad()
     def compute_metrics(self):
         begin = time.time()
         epoch = self.epoch + 1
-        if self.frequency and (
-            epoch == 0 or epoch == self.n_epochs or (epoch % self.frequency == 0)
-        ):
-            with torch.set_grad_enabled(False):
+        if self.is_metrics_epoch(epoch):
+            running = self.running_statistics()
+            with torch.set_grad_enabled(False), self.autocast():
                 self.model.eval()
                 logger.debug("\nEPOCH [%d/%d]: " % (epoch, self.n_epochs))
 
-                for name, posterior in self._posteriors.items():
-                    message = " ".join([s.capitalize() for s in name.split("_")[-2:]])
-                    if hasattr(posterior, "to_monitor"):
-                        for metric in posterior.to_monitor:
-                            if metric not in self.metrics_to_monitor:
-                                logger.debug(message, end=" : ")
-                                result = getattr(posterior, metric)()
-                                self.history[metric + "_" + name] += [result]
-                    for metric in self.metrics_to_monitor:
-                        result = getattr(posterior, metric)()
-                        self.history[metric + "_" + name] += [result]
+                tasks = self.metric_tasks()
+                if self.n_eval_workers > 1 and len(tasks) > 1:
+                    results = self.compute_metrics_concurrently(tasks, running)
+                else:
+                    results = [
+                        self.compute_metric(name, metric, running)
+                        for name, metric in tasks
+                    ]
+                self.record_metrics(tasks, results, running)
                 self.model.train()
         self.compute_metrics_time += time.time() - begin
 
-    def train(self, n_epochs=20, lr=1e-3, eps=0.01, params=None):
-        begin = time.time()
+    def record_metrics(self, tasks, results, running):
+        if running:
+            for statistic in ["reconstruction_loss", "kl_divergence"]:
+                key = statistic + "_" + self.running_elbo_posterior
+                self.history[key] += [running[statistic]]
+        # results are merged in the order of the tasks, whatever the order they completed in
+        for (name, metric), result in zip(tasks, results):
+            self.history[metric + "_" + name] += [result]
+
+    def submit_metrics(self):
+        r"""Copies the current weights into the shadow model and starts computing the metrics of the epoch
+        on it in the background."""
+        if self._shadow_model is None:
+            self._shadow_model = copy.deepcopy(self.model)
+            # the compiled forward of the copy would still be the one bound to the model being trained
+            if getattr(self._shadow_model, "_compiled_call_impl", None) is not None:
+                self._shadow_model._compiled_call_impl = None
+            self._metrics_executor = ThreadPoolExecutor(max_workers=1)
+            # the evaluation draws its random numbers from its own generators, so that the random stream of
+            # the training, running concurrently, does not depend on it
+            self._metrics_generators = (
+                torch.Generator(),
+                torch.Generator(device="cuda" if self.use_cuda else "cpu"),
+            )
+            for module in self._shadow_model.modules():
+                if isinstance(module, Encoder):
+                    module.generator = self._metrics_generators[1]
+        self._shadow_model.load_state_dict(self.model.state_dict())
+        self._shadow_model.eval()
+        self._shadow_epoch = self.epoch
+        for generator in self._metrics_generators:
+            generator.manual_seed(self.epoch + 1)
+        posteriors = OrderedDict()
+        for name, posterior in self._posteriors.items():
+            # a sequential copy, so that the training loop keeps the samplers of the posteriors to itself
+            posterior = posterior.sequential(
+                batch_size=posterior.data_loader_kwargs.get("batch_size", 128)
+            ).update({"generator": self._metrics_generators[0]})
+            posterior.model = self._shadow_model
+            posteriors[name] = posterior
+        tasks, running = self.metric_tasks(), self.running_statistics()
+
+        def compute_metrics():
+            with torch.no_grad(), self.autocast():
+                return [
+                    self.compute_metric(name, metric, running, posteriors)
+                    for name, metric in tasks
+                ]
+
+        future = self._metrics_executor.submit(compute_metrics)
+        self._pending_metrics = (future, tasks, running)
+
+    def collect_metrics(self, wait=True):
+        r"""Records the results of the background metrics computation into ``history``, waiting for it to end
+        if ``wait`` is True.
+
+        :return: True if new results were recorded
+        """
+        if self._pending_metrics is None:
+            return False
+        future, tasks, running = self._pending_metrics
+        if not (wait or future.done()):
+            return False
+        self._pending_metrics = None
+        self.record_metrics(tasks, future.result(), running)
+        return True
+
+    def metric_tasks(self):
+        r"""The (posterior name, metric) pairs evaluated by ``compute_metrics``, in a deterministic order."""
+        tasks = []
+        for name, posterior in self._posteriors.items():
+            if hasattr(posterior, "to_monitor"):
+                tasks += [
+                    (name, metric)
+                    for metric in posterior.to_monitor
+                    if metric not in self.metrics_to_monitor
+                ]
+            tasks += [(name, metric) for metric in sorted(self.metrics_to_monitor)]
+        return tasks
+
+    def compute_metrics_concurrently(self, tasks, running):
+        n_workers = min(self.n_eval_workers, len(tasks))
+        n_threads = torch.get_num_threads()
+        n_threads_worker = max(1, n_threads // n_workers)
+
+        def compute_metric(name, metric):
+            # the number of threads, the grad mode and autocast are thread local
+            torch.set_num_threads(n_threads_worker)
+            with torch.no_grad(), self.autocast():
+                return self.compute_metric(name, metric, running)
+
+        torch.set_num_threads(n_threads_worker)
+        try:
+            with ThreadPoolExecutor(n_workers) as executor:
+                futures = [
+                    executor.submit(compute_metric, name, metric)
+                    for name, metric in tasks
+                ]
+                return [future.result() for future in futures]
+        finally:
+            torch.set_num_threads(n_threads)
+
+    def compute_metric(self, name, metric, running, posteriors=None):
+        if running and name == self.running_elbo_posterior and metric == "elbo":
+            return running["elbo"]
+        posteriors = self._posteriors if posteriors is None else posteriors
+        return getattr(posteriors[name], metric)()
+
+    def train(
+        self,
+        n_epochs=20,
+        lr=1e-3,
+        eps=0.01,
+        params=None,
+        resume_from=None,
+        max_time=None,
+        target_metric=None,
+        target_value=None,
+        target_on="test_set",
+    ):
+        """
+        :param resume_from: path of a checkpoint written by a previous run with the same arguments,
+            training then continues exactly from the end of the checkpointed epoch
+        :param max_time: wall-clock budget of the training in seconds, checked at the end of each epoch
+        :param target_metric: metric, e.g. ``'elbo'``, that ends the training as soon as its value on
+            ``target_on`` reaches ``target_value``. It is added to the monitored metrics for this call, and
+            checked whenever they are computed, which requires ``frequency``.
+        :param target_value: value of ``target_metric`` to reach
+        :param target_on: name of the posterior on which ``target_metric`` is monitored
+
+        Why the training ended is stored in ``stop_reason``: ``'n_epochs'``, ``'early_stopping'``,
+        ``'target'`` or ``'max_time'``.
+        """
+        from tqdm import trange
+
+        begin = self._train_begin = time.time()
         self.model.train()
 
-        if params is None:
-            params = filter(lambda p: p.requires_grad, self.model.parameters())
+        self.max_time = max_time
+        self.target = None
+        added_metric = None
+        if target_metric is not None:
+            if not self.frequency:
+                raise ValueError("target_metric requires a frequency of the metrics")
+            mode = getattr(Posterior, target_metric).mode
+            self.target = (target_metric + "_" + target_on, target_value, mode)
+            if target_metric not in self.metrics_to_monitor:
+                added_metric = target_metric
+                self.metrics_to_monitor.add(target_metric)
+        self.stop_reason = None
+        try:
+            if params is None:
+                params = filter(lambda p: p.requires_grad, self.model.parameters())
+
+            lr = self.scale_lr(lr)
+            self.optimizer = torch.optim.Adam(
+                params, lr=lr, eps=eps, weight_decay=self.weight_decay
+            )
+            n_batches = len(self.data_loaders_loop())
+            n_steps = int(np.ceil(n_batches / self.accumulation_steps))
+            n_iter_warmup = int(self.lr_warmup_epochs * n_steps)
+            self.n_iter_total = n_epochs * n_steps
+
+            self.compute_metrics_time = 0
+            self.n_epochs = n_epochs
+            if resume_from is not None:
+                self.load_checkpoint_state(_load_checkpoint(resume_from))
+                first_epoch = self.epoch + 1
+            else:
+                self.n_iter = 0
+                self.reset_running_elbo()
+                self.compute_metrics()
+                first_epoch = 0
+
+            with trange(
+                first_epoch,
+                n_epochs,
+                desc="training",
+                file=sys.stdout,
+                disable=not self.show_progbar,
+            ) as pbar:
+                # We have to use tqdm this way so it works in Jupyter notebook.
+                # See https://stackoverflow.com/questions/42212810/tqdm-in-jupyter-notebook
+                for self.epoch in pbar:
+                    if self.profiler is not None:
+                        self.profiler.reset()
+                    self.on_epoch_begin()
+                    self.reset_running_elbo()
+                    pbar.update(1)
+                    with self.trace(self.epoch):
+                        self.train_epoch(lr, n_iter_warmup)
+                        with self.phase("metrics"):
+                            continue_training = self.on_epoch_end()
+                    if self.profile:
+                        for key, value in self.profiler.end_epoch().items():
+                            self.history[key].append(value)
+
+                    if not continue_training:
+                        break
+                    if self.is_checkpoint_epoch(self.epoch):
+                        self.save_checkpoint(
+                            self.checkpoint_path.format(epoch=self.epoch)
+                        )
+            if self.stop_reason is None:
+                self.stop_reason = "n_epochs"
+            logger.info(
+                "Training stopped at epoch %d: %s" % (self.epoch, self.stop_reason)
+            )
+            self.wait_checkpoint()
+            if self._checkpoint_executor is not None:
+                self._checkpoint_executor.shutdown()
+                self._checkpoint_executor = None
+            if self.async_metrics and self.collect_metrics():
+                self.update_early_stopping(self._shadow_model, self._shadow_epoch)
+
+            if self.early_stopping.save_best_state_metric is not None:
+                self.model.load_state_dict(self.best_state_dict)
+                # the statistics of the last epoch do not describe the restored weights
+                self.reset_running_elbo()
+                self.compute_metrics()
+
+            self.model.eval()
+            self.training_time += (time.time() - begin) - self.compute_metrics_time
+            if self.frequency:
+                logger.debug(
+                    "\nTraining time:  %i s. / %i epochs"
+                    % (int(self.training_time), self.n_epochs)
+                )
+        finally:
+            if added_metric is not None:
+                self.metrics_to_monitor.discard(added_metric)
 
-        optimizer = self.optimizer = torch.optim.Adam(
-            params, lr=lr, eps=eps, weight_decay=self.weight_decay
+    def on_epoch_begin(self):
+        pass
+
+    def reset_running_elbo(self):
+        self._running_reconstruction_loss = 0.0
+        self._running_kl_divergence = 0.0
+        self._running_n_cells = 0
+
+    def accumulate_running_elbo(self, reconst_loss, kl_divergence):
+        r"""Adds the per-cell losses of a training minibatch to the running statistics of the epoch."""
+        self._running_reconstruction_loss += reconst_loss.detach().float().sum()
+        self._running_kl_divergence += kl_divergence.detach().float().sum()
+        self._running_n_cells += len(reconst_loss)
+
+    def running_statistics(self):
+        r"""Per-cell reconstruction loss, KL divergence and ELBO averaged over the minibatches of the current
+        epoch, or an empty dict if nothing was accumulated."""
+        if self.running_elbo_posterior is None or not self._running_n_cells:
+            return {}
+        reconstruction_loss = (
+            float(self._running_reconstruction_loss) / self._running_n_cells
+        )
+        kl_divergence = float(self._running_kl_divergence) / self._running_n_cells
+        return {
+            "reconstruction_loss": reconstruction_loss,
+            "kl_divergence": kl_divergence,
+            "elbo": reconstruction_loss + kl_divergence,
+        }
+
+    def checkpoint_state(self):
+        r"""A copy of everything needed to resume training after the current epoch. Subclasses holding
+        additional training state should extend it, along with ``load_checkpoint_state``."""
+        state = {
+            "epoch": self.epoch,
+            "n_iter": self.n_iter,
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "history": dict(self.history),
+            "early_stopping": vars(self.early_stopping),
+            "best_state_dict": self.best_state_dict
+            if self.best_state is not None
+            else None,
+            "best_epoch": self.best_epoch,
+            "training_time": self.training_time
+            + (time.time() - self._train_begin)
+            - self.compute_metrics_time,
+            "rng_states": {
+                "torch": torch.get_rng_state(),
+                "numpy": np.random.get_state(),
+                "random": random.getstate(),
+            },
+        }
+        if self.use_cuda:
+            state["rng_states"]["cuda"] = torch.cuda.get_rng_state_all()
+        return copy.deepcopy(state)
+
+    def load_checkpoint_state(self, state):
+        self.epoch = state["epoch"]
+        self.n_iter = state["n_iter"]
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.history = defaultdict(list, state["history"])
+        vars(self.early_stopping).update(state["early_stopping"])
+        if state["best_state_dict"] is not None:
+            self.best_state.load_state_dict(state["best_state_dict"])
+        self.best_epoch = state["best_epoch"]
+        self.training_time = state["training_time"]
+        torch.set_rng_state(state["rng_states"]["torch"])
+        np.random.set_state(state["rng_states"]["numpy"])
+        random.setstate(state["rng_states"]["random"])
+        if self.use_cuda and "cuda" in state["rng_states"]:
+            torch.cuda.set_rng_state_all(state["rng_states"]["cuda"])
+
+    def save_checkpoint(self, path):
+        r"""Writes a checkpoint to ``path`` on a background thread. The state is copied beforehand, so
+        training goes on while the file is written."""
+        state = self.checkpoint_state()
+        # at most one pending write, so that snapshots do not pile up in memory if the disk is slow
+        self.wait_checkpoint()
+        if self._checkpoint_executor is None:
+            self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self._checkpoint_future = self._checkpoint_executor.submit(
+            _save_atomically, state, path
         )
 
-        self.compute_metrics_time = 0
-        self.n_epochs = n_epochs
-        self.compute_metrics()
-
-        with trange(
-            n_epochs, desc="training", file=sys.stdout, disable=not self.show_progbar
-        ) as pbar:
-            # We have to use tqdm this way so it works in Jupyter notebook.
-            # See https://stackoverflow.com/questions/42212810/tqdm-in-jupyter-notebook
-            for self.epoch in pbar:
-                self.on_epoch_begin()
-                pbar.update(1)
-                for tensors_list in self.data_loaders_loop():
-                    loss = self.loss(*tensors_list)
+    def wait_checkpoint(self):
+        r"""Blocks until the pending checkpoint write, if any, is done, and raises its error if it failed."""
+        if self._checkpoint_future is not None:
+            future, self._checkpoint_future = self._checkpoint_future, None
+            future.result()
+
+    def train_epoch(self, lr, n_iter_warmup=0):
+        r"""One pass of the training loop over ``training_posteriors``.
+
+        :param lr: learning rate reached at the end of the warmup
+        :param n_iter_warmup: number of optimizer steps of the warmup
+        """
+        optimizer = self.optimizer
+        profiler = self.profiler
+        data_loaders_loop = self.data_loaders_loop()
+        n_batches = len(data_loaders_loop)
+        if profiler is not None:
+            data_loaders_loop = profiler.iterate(data_loaders_loop, "data")
+        for i_batch, tensors_list in enumerate(data_loaders_loop):
+            # the last accumulation group of an epoch may hold fewer minibatches
+            i_group = i_batch % self.accumulation_steps
+            group_size = min(self.accumulation_steps, n_batches - (i_batch - i_group))
+            with self.phase("forward"), self.autocast():
+                loss = self.loss(*tensors_list) * self.batch_weight(tensors_list)
+            with self.phase("backward"):
+                if i_group == 0:
                     optimizer.zero_grad()
-                    loss.backward()
+                (loss / group_size).backward()
+            if i_group + 1 == group_size:
+                with self.phase("step"):
+                    if self.lr_schedule is not None or self.n_iter < n_iter_warmup:
+                        scheduled_lr = self.scheduled_lr(lr, n_iter_warmup)
+                        for param_group in optimizer.param_groups:
+                            param_group["lr"] = scheduled_lr
+                    self.before_optimizer_step()
                     optimizer.step()
+                self.n_iter += 1
+            if profiler is not None:
+                profiler.count(len(tensors_list[0][0]))
 
-                if not self.on_epoch_end():
-                    break
+    def scheduled_lr(self, lr, n_iter_warmup=0):
+        r"""Learning rate of optimizer step ``n_iter``: the linear warmup over ``n_iter_warmup`` steps, then
+        ``lr_schedule`` over the remaining steps of ``train``."""
+        if self.n_iter < n_iter_warmup:
+            return lr * (self.n_iter + 1) / n_iter_warmup
+        if self.lr_schedule is None:
+            return lr
+        progress = min(
+            1.0,
+            (self.n_iter - n_iter_warmup) / max(1, self.n_iter_total - n_iter_warmup),
+        )
+        if self.lr_schedule == "cosine":
+            return _anneal(lr, 0.0, progress)
+        if progress < 0.3:
+            return _anneal(lr / 25, lr, progress / 0.3)
+        return _anneal(lr, lr / 25e4, (progress - 0.3) / 0.7)
 
-        if self.early_stopping.save_best_state_metric is not None:
-            self.model.load_state_dict(self.best_state_dict)
-            self.compute_metrics()
+    def lr_range_test(self, min_lr=1e-6, max_lr=1.0, n_iter=100, eps=0.01, beta=0.98):
+        r"""Trains for up to ``n_iter`` optimizer steps with a learning rate growing exponentially from ``min_lr``
+        to ``max_lr``, stopping when the loss diverges, then restores the weights of the model.
 
+        The steps accumulate ``accumulation_steps`` minibatches as in ``train``, and the learning rates are
+        given in the units of the ``lr`` of ``train``: ``lr_scaling`` applies to them in the same way.
+
+        :param beta: factor of the exponential moving average smoothing the losses
+        :return: the learning rates, the smoothed losses of the steps and the suggested learning rate, a tenth
+            of the one minimizing the smoothed loss, to be passed to ``train``
+        """
+        state = copy.deepcopy(self.model.state_dict())
+        epoch, self.epoch = self.epoch, 0
+        self.on_epoch_begin()
+        self.model.train()
+        optimizer = torch.optim.Adam(
+            filter(lambda p: p.requires_grad, self.model.parameters()),
+            lr=min_lr,
+            eps=eps,
+            weight_decay=self.weight_decay,
+        )
+
+        def minibatches():
+            while True:
+                yield from self.data_loaders_loop()
+
+        lrs, losses, average = [], [], 0.0
+        batches = minibatches()
+        for i in range(n_iter):
+            lr = min_lr * (max_lr / min_lr) ** (i / max(1, n_iter - 1))
+            for param_group in optimizer.param_groups:
+                param_group["lr"] = self.scale_lr(lr)
+            optimizer.zero_grad()
+            loss = 0.0
+            for tensors_list in itertools.islice(batches, self.accumulation_steps):
+                with self.autocast():
+                    batch_loss = self.loss(*tensors_list) * self.batch_weight(
+                        tensors_list
+                    )
+                (batch_loss / self.accumulation_steps).backward()
+                loss += batch_loss.item() / self.accumulation_steps
+            self.before_optimizer_step()
+            optimizer.step()
+            # bias corrected moving average
+            average = beta * average + (1 - beta) * loss
+            lrs.append(lr)
+            losses.append(average / (1 - beta ** (i + 1)))
+            if not np.isfinite(losses[-1]) or losses[-1] > 4 * min(losses):
+                break
+
+        self.model.load_state_dict(state)
         self.model.eval()
-        self.training_time += (time.time() - begin) - self.compute_metrics_time
-        if self.frequency:
-            logger.debug(
-                "\nTraining time:  %i s. / %i epochs"
-                % (int(self.training_time), self.n_epochs)
+        self.epoch = epoch
+        self.reset_running_elbo()
+        lrs, losses = np.array(lrs), np.array(losses)
+        finite = np.isfinite(losses)
+        if not finite.any():
+            raise ValueError(
+                "The loss of the range test is not finite from its first step"
             )
+        return lrs, losses, lrs[np.argmin(np.where(finite, losses, np.inf))] / 10
 
-    def on_epoch_begin(self):
+    def before_optimizer_step(self):
         pass
 
+    def batch_weight(self, tensors_list):
+        # losses are averaged over each minibatch: with variable batch sizes, weight them by their
+        # size relative to the mean batch size so that every cell contributes equally to an epoch
+        batch_sampler = self.training_posteriors()[0].data_loader.batch_sampler
+        if hasattr(batch_sampler, "mean_batch_size"):
+            return len(tensors_list[0][0]) / batch_sampler.mean_batch_size
+        return 1.0
+
     def on_epoch_end(self):
-        self.compute_metrics()
+        if not self.async_metrics:
+            self.compute_metrics()
+            continue_training = self.update_early_stopping(self.model, self.epoch)
+        else:
+            continue_training = True
+            # the previous results are only waited for when the shadow model is needed again
+            is_metrics_epoch = self.is_metrics_epoch(self.epoch + 1)
+            is_checkpoint_epoch = self.is_checkpoint_epoch(self.epoch)
+            if self.collect_metrics(wait=is_metrics_epoch or is_checkpoint_epoch):
+                continue_training = self.update_early_stopping(
+                    self._shadow_model, self._shadow_epoch
+                )
+            if is_metrics_epoch and continue_training:
+                self.submit_metrics()
+                # a checkpoint holds no metrics in flight, so that training resumes from it as it went on
+                if is_checkpoint_epoch and self.collect_metrics():
+                    continue_training = self.update_early_stopping(
+                        self._shadow_model, self._shadow_epoch
+                    )
+        return self.update_stop_reason(continue_training)
+
+    def update_stop_reason(self, continue_training):
+        r"""Sets ``stop_reason`` if the early stopping, the ``target_metric`` or the ``max_time`` of ``train``
+        end the training after this epoch.
+
+        :return: False if training should stop
+        """
+        if not continue_training:
+            self.stop_reason = "early_stopping"
+        elif self.target is not None and self.history.get(self.target[0]):
+            key, target_value, mode = self.target
+            value = self.history[key][-1]
+            if (value <= target_value) if mode == "min" else (value >= target_value):
+                self.stop_reason = "target"
+        if self.stop_reason is None and self.max_time is not None:
+            if time.time() - self._train_begin >= self.max_time:
+                self.stop_reason = "max_time"
+        return self.stop_reason is None
+
+    def update_early_stopping(self, model, epoch):
+        r"""Updates the early stopping and best state with the last metrics in ``history``, which were
+        computed on ``model`` with the weights of ``epoch``.
+
+        :return: False if training should stop
+        """
         on = self.early_stopping.on
         early_stopping_metric = self.early_stopping.early_stopping_metric
         save_best_state_metric = self.early_stopping.save_best_state_metric
@@ -174,8 +803,8 @@ class Trainer:
             if self.early_stopping.update_state(
                 self.history[save_best_state_metric + "_" + on][-1]
             ):
-                self.best_state_dict = self.model.state_dict()
-                self.best_epoch = self.epoch
+                self.best_state.update(model)
+                self.best_epoch = epoch
 
         continue_training = True
         if early_stopping_metric is not None and on is not None:
@@ -194,15 +823,20 @@ class Trainer:
     def posteriors_loop(self):
         pass
 
-    def data_loaders_loop(
-        self
-    ):  # returns an zipped iterable corresponding to loss signature
-        data_loaders_loop = [self._posteriors[name] for name in self.posteriors_loop]
-        return zip(
-            data_loaders_loop[0],
-            *[cycle(data_loader) for data_loader in data_loaders_loop[1:]]
+    def data_loaders_loop(self):
+        r"""The minibatches of an epoch of ``training_posteriors``, one list of tensors per posterior at each
+        step as in the signature of ``loss``."""
+        return MultiStreamLoader(
+            self.training_posteriors(),
+            ratios=self.stream_ratios,
+            batch_sizes=self.stream_batch_sizes,
+            n_prefetch=self.n_prefetch,
         )
 
+    def training_posteriors(self):
+        r"""The posteriors iterated by the training loop, in the order of ``posteriors_loop``."""
+        return [self._posteriors[name] for name in self.posteriors_loop]
+
     def register_posterior(self, name, value):
         name = name.strip("_")
         self._posteriors[name] = value
@@ -215,6 +849,24 @@ class Trainer:
         for name, posterior in self._posteriors.items():
             self.register_posterior(name, posterior.corrupted())
 
+    def block_shuffle_posteriors(self, block_size=128, window_size=8):
+        for name in self.posteriors_loop:
+            self.register_posterior(
+                name,
+                self._posteriors[name].block_shuffle(
+                    block_size=block_size, window_size=window_size
+                ),
+            )
+
+    def nonzero_balance_posteriors(self, max_nnz=None):
+        for name in self.posteriors_loop:
+            self.register_posterior(
+                name,
+                self._posteriors[name].nonzero_balanced(
+                    batch_size=self.data_loader_kwargs["batch_size"], max_nnz=max_nnz
+                ),
+            )
+
     def uncorrupt_posteriors(self):
         for name_, posterior in self._posteriors.items():
             self.register_posterior(name_, posterior.uncorrupted())
@@ -258,6 +910,8 @@ class Trainer:
             if gene_dataset is None and hasattr(self, "model")
             else gene_dataset
         )
+        from sklearn.model_selection._split import _validate_shuffle_split
+
         n = len(gene_dataset)
         n_train, n_test = _validate_shuffle_split(n, test_size, train_size)
         np.random.seed(seed=seed)
@@ -306,6 +960,79 @@ class SequentialSubsetSampler(SubsetRandomSampler):
         return iter(self.indices)
 
 
+class StateSnapshot:
+    r"""Preallocated copy of the state dict of a model, updated in place.
+
+    One buffer is allocated per tensor of the state dict when the snapshot is created, so that keeping the best
+    weights of a training does not allocate a model copy on every improvement.
+
+    Args:
+        :model: The model whose state is copied.
+        :path: Optional file backing the buffers as a memory map, for models too large to keep a second copy in
+            memory. Default: ``None``, buffers are allocated on the device of each tensor.
+
+    Examples:
+        >>> snapshot = StateSnapshot(vae)
+        >>> snapshot.update(vae)
+        >>> vae.load_state_dict(snapshot.state_dict())
+    """
+
+    def __init__(self, model, path=None):
+        state_dict = model.state_dict()
+        self.buffers = OrderedDict()
+        if path is None:
+            for key, tensor in state_dict.items():
+                self.buffers[key] = torch.empty_like(tensor)
+            return
+        # all buffers are views on one byte array, aligned on 8 bytes
+        offsets, offset = [], 0
+        for tensor in state_dict.values():
+            offsets.append(offset)
+            offset += -(-tensor.numel() * tensor.element_size() // 8) * 8
+        self.memmap = np.memmap(
+            path, dtype=np.uint8, mode="w+", shape=(max(offset, 1),)
+        )
+        for (key, tensor), offset in zip(state_dict.items(), offsets):
+            # the bytes are reinterpreted by torch, which supports dtypes unknown to numpy such as bfloat16
+            array = self.memmap[
+                offset : offset + tensor.numel() * tensor.element_size()
+            ]
+            self.buffers[key] = (
+                torch.from_numpy(array).view(tensor.dtype).view(tensor.shape)
+            )
+
+    @torch.no_grad()
+    def update(self, model):
+        self.load_state_dict(model.state_dict())
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        for key, tensor in state_dict.items():
+            self.buffers[key].copy_(tensor)
+
+    def state_dict(self):
+        return self.buffers
+
+
+def _anneal(start, end, progress):
+    # cosine interpolation from start to end as progress goes from 0 to 1
+    return end + (start - end) * (1 + np.cos(np.pi * progress)) / 2
+
+
+def _save_atomically(state, path):
+    # a preemption during the write leaves the previous checkpoint untouched
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _load_checkpoint(path):
+    # the random states of numpy and random are not tensors, which torch.load refuses by default from torch 2.6
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(path, weights_only=False)
+    return torch.load(path)
+
+
 class EarlyStopping:
     def __init__(
         self,
@@ -112,7 +112,17 @@ def compute_marginal_log_likelihood(vae, posterior, n_samples_mc=100):
     return -log_lkl / n_samples
 
 
-def log_zinb_positive(x, mu, theta, pi, eps=1e-8):
+_scripted_functions = {}
+
+
+def scripted(function):
+    r"""TorchScript version of ``function``, one of the log likelihoods of this module, compiled on first use."""
+    if function not in _scripted_functions:
+        _scripted_functions[function] = torch.jit.script(function)
+    return _scripted_functions[function]
+
+
+def log_zinb_positive(x, mu, theta, pi, eps: float = 1e-8):
     """
     Note: All inputs are torch Tensors
     log likelihood (scalar) of a minibatch according to a zinb model.
@@ -126,8 +136,11 @@ def log_zinb_positive(x, mu, theta, pi, eps=1e-8):
     eps: numerical stability constant
     """
 
-    # theta is the dispersion rate. If .ndimension() == 1, it is shared for all cells (regardless of batch or labels)
-    if theta.ndimension() == 1:
+    # the lgamma terms lose too much precision in bfloat16, keep them in float32 under autocast
+    x, mu, theta, pi = x.float(), mu.float(), theta.float(), pi.float()
+
+    # theta is the dispersion rate. If .dim() == 1, it is shared for all cells (regardless of batch or labels)
+    if theta.dim() == 1:
         theta = theta.view(
             1, theta.size(0)
         )  # In this case, we reshape theta for broadcasting
@@ -138,7 +151,7 @@ def log_zinb_positive(x, mu, theta, pi, eps=1e-8):
     pi_theta_log = -pi + theta * (log_theta_eps - log_theta_mu_eps)
 
     case_zero = F.softplus(pi_theta_log) - softplus_pi
-    mul_case_zero = torch.mul((x < eps).type(torch.float32), case_zero)
+    mul_case_zero = torch.mul((x < eps).float(), case_zero)
 
     case_non_zero = (
         -softplus_pi
@@ -148,14 +161,14 @@ def log_zinb_positive(x, mu, theta, pi, eps=1e-8):
         - torch.lgamma(theta)
         - torch.lgamma(x + 1)
     )
-    mul_case_non_zero = torch.mul((x > eps).type(torch.float32), case_non_zero)
+    mul_case_non_zero = torch.mul((x > eps).float(), case_non_zero)
 
     res = mul_case_zero + mul_case_non_zero
 
     return torch.sum(res, dim=-1)
 
 
-def log_nb_positive(x, mu, theta, eps=1e-8):
+def log_nb_positive(x, mu, theta, eps: float = 1e-8):
     """
     Note: All inputs should be torch Tensors
     log likelihood (scalar) of a minibatch according to a nb model.
@@ -165,7 +178,10 @@ def log_nb_positive(x, mu, theta, eps=1e-8):
     theta: inverse dispersion parameter (has to be positive support) (shape: minibatch x genes)
     eps: numerical stability constant
     """
-    if theta.ndimension() == 1:
+    # the lgamma terms lose too much precision in bfloat16, keep them in float32 under autocast
+    x, mu, theta = x.float(), mu.float(), theta.float()
+
+    if theta.dim() == 1:
         theta = theta.view(
             1, theta.size(0)
         )  # In this case, we reshape theta for broadcasting
@@ -3,7 +3,6 @@ from typing import Iterable
 
 import torch
 from torch import nn as nn
-from torch.distributions import Normal
 
 from scvi.models.utils import one_hot
 
@@ -64,6 +63,12 @@ class FCLayers(nn.Module):
                 ]
             )
         )
+        # the layers of each block without the disabled ones, so that the forward pass on 2D inputs runs
+        # them in sequence without type checks
+        self.blocks = [
+            (layers[0], [layer for layer in layers[1:] if layer is not None])
+            for layers in self.fc_layers
+        ]
 
     def forward(self, x: torch.Tensor, *cat_list: int):
         r"""Forward computation on ``x``.
@@ -87,6 +92,14 @@ class FCLayers(nn.Module):
                 else:
                     one_hot_cat = cat  # cat has already been one_hot encoded
                 one_hot_cat_list += [one_hot_cat]
+        if x.dim() == 2:
+            for linear, layers in self.blocks:
+                if one_hot_cat_list:
+                    x = torch.cat((x, *one_hot_cat_list), dim=-1)
+                x = linear(x)
+                for layer in layers:
+                    x = layer(x)
+            return x
         for layers in self.fc_layers:
             for layer in layers:
                 if layer is not None:
@@ -125,6 +138,8 @@ class Encoder(nn.Module):
     :param n_hidden: The number of nodes per hidden layer
     :dropout_rate: Dropout rate to apply to each of the hidden layers
     """
+    # random number generator of the samples, the global one if None
+    generator = None
 
     def __init__(
         self,
@@ -149,7 +164,14 @@ class Encoder(nn.Module):
         self.var_encoder = nn.Linear(n_hidden, n_output)
 
     def reparameterize(self, mu, var):
-        return Normal(mu, var.sqrt()).rsample()
+        # same as Normal(mu, var.sqrt()).rsample(), without building the distribution
+        if self.generator is None:
+            noise = torch.randn_like(mu)
+        else:
+            noise = torch.randn(
+                mu.size(), dtype=mu.dtype, device=mu.device, generator=self.generator
+            )
+        return mu + var.sqrt() * noise
 
     def forward(self, x: torch.Tensor, *cat_list: int):
         r"""The forward computation for a single sample.
@@ -177,7 +177,11 @@ class SCANVI(VAE):
 
         reconst_loss = self.get_reconstruction_loss(x, px_rate, px_r, px_dropout)
 
-        # KL Divergence
+        # KL Divergence, kept in float32 under autocast
+        qz1_m, qz1_v, qz2_m, qz2_v, pz1_m, pz1_v, ql_m, ql_v, z1, z1s = (
+            t.float()
+            for t in (qz1_m, qz1_v, qz2_m, qz2_v, pz1_m, pz1_v, ql_m, ql_v, z1, z1s)
+        )
         mean = torch.zeros_like(qz2_m)
         scale = torch.ones_like(qz2_v)
 
@@ -197,7 +201,7 @@ class SCANVI(VAE):
                 kl_divergence_z2 + kl_divergence_l,
             )
 
-        probs = self.classifier(z1)
+        probs = self.classifier(z1).float()
         reconst_loss += loss_z1_weight + (
             (loss_z1_unweight).view(self.n_labels, -1).t() * probs
         ).sum(dim=1)
@@ -6,7 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Normal, kl_divergence as kl
 
-from scvi.models.log_likelihood import log_zinb_positive, log_nb_positive
+from scvi.models.log_likelihood import log_zinb_positive, log_nb_positive, scripted
 from scvi.models.modules import Encoder, DecoderSCVI, LinearDecoderSCVI
 from scvi.models.utils import one_hot
 
@@ -43,6 +43,8 @@ class VAE(nn.Module):
         ... n_labels=gene_dataset.n_labels)
 
     """
+    # set by ``Trainer(compile_model=True)`` when ``torch.compile`` is not available
+    script_likelihoods = False
 
     def __init__(
         self,
@@ -162,12 +164,18 @@ class VAE(nn.Module):
         """
         return self.inference(x, batch_index=batch_index, y=y, n_samples=n_samples)[2]
 
+    def likelihood(self, function):
+        r"""Returns the log likelihood ``function``, compiled with TorchScript if ``script_likelihoods`` is set."""
+        return scripted(function) if self.script_likelihoods else function
+
     def get_reconstruction_loss(self, x, px_rate, px_r, px_dropout):
         # Reconstruction Loss
         if self.reconstruction_loss == "zinb":
-            reconst_loss = -log_zinb_positive(x, px_rate, px_r, px_dropout)
+            reconst_loss = -self.likelihood(log_zinb_positive)(
+                x, px_rate, px_r, px_dropout
+            )
         elif self.reconstruction_loss == "nb":
-            reconst_loss = -log_nb_positive(x, px_rate, px_r)
+            reconst_loss = -self.likelihood(log_nb_positive)(x, px_rate, px_r)
         return reconst_loss
 
     def scale_from_z(self, sample_batch, fixed_batch):
@@ -230,7 +238,8 @@ class VAE(nn.Module):
             x, batch_index, y
         )
 
-        # KL Divergence
+        # KL Divergence, kept in float32 under autocast
+        qz_m, qz_v, ql_m, ql_v = qz_m.float(), qz_v.float(), ql_m.float(), ql_v.float()
         mean = torch.zeros_like(qz_m)
         scale = torch.ones_like(qz_v)
 
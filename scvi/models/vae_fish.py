@@ -246,11 +246,13 @@ class VAEF(VAE):
         # Reconstruction Loss
         if mode == "scRNA":
             if self.reconstruction_loss == "zinb":
-                reconst_loss = -log_zinb_positive(
+                reconst_loss = -self.likelihood(log_zinb_positive)(
                     x, px_rate, torch.exp(px_r), px_dropout
                 )
             elif self.reconstruction_loss == "nb":
-                reconst_loss = -log_nb_positive(x, px_rate, torch.exp(px_r))
+                reconst_loss = -self.likelihood(log_nb_positive)(
+                    x, px_rate, torch.exp(px_r)
+                )
 
         else:
             if self.reconstruction_loss_fish == "poisson":
@@ -348,7 +350,8 @@ class VAEF(VAE):
             x, px_rate, px_r, px_dropout, mode, weighting
         )
 
-        # KL Divergence
+        # KL Divergence, kept in float32 under autocast
+        qz_m, qz_v = qz_m.float(), qz_v.float()
         mean = torch.zeros_like(qz_m)
         scale = torch.ones_like(qz_v)
 
@@ -357,7 +360,7 @@ class VAEF(VAE):
         )
         if self.model_library:
             kl_divergence_l = kl(
-                Normal(ql_m, torch.sqrt(ql_v)),
+                Normal(ql_m.float(), torch.sqrt(ql_v.float())),
                 Normal(local_l_mean, torch.sqrt(local_l_var)),
             ).sum(dim=1)
             kl_divergence = kl_divergence_z + kl_divergence_l
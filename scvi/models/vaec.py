@@ -119,7 +119,8 @@ class VAEC(VAE):
         )
         reconst_loss = self.get_reconstruction_loss(xs, px_rate, px_r, px_dropout)
 
-        # KL Divergence
+        # KL Divergence, kept in float32 under autocast
+        qz_m, qz_v, ql_m, ql_v = qz_m.float(), qz_v.float(), ql_m.float(), ql_v.float()
         mean = torch.zeros_like(qz_m)
         scale = torch.ones_like(qz_v)
 
@@ -136,7 +137,7 @@ class VAEC(VAE):
 
         reconst_loss = reconst_loss.view(self.n_labels, -1)
 
-        probs = self.classifier(x_)
+        probs = self.classifier(x_).float()
         reconst_loss = (reconst_loss.t() * probs).sum(dim=1)
 
         kl_divergence = (kl_divergence_z.view(self.n_labels, -1).t() * probs).sum(dim=1)
@@ -4,13 +4,27 @@
 
 """Tests for `scvi` package."""
 
+import contextlib
+import hashlib
+import http.server
+import threading
+from functools import partial
+from types import SimpleNamespace
+
 import numpy as np
+import pandas as pd
+import pytest
+import torch
+import scipy.sparse as sp_sparse
 
 from scvi.benchmark import (
     all_benchmarks,
     benchmark,
     benchmark_fish_scrna,
+    fast_training_benchmark,
+    import_time_benchmark,
     ldvae_benchmark,
+    mixed_precision_benchmark,
 )
 from scvi.dataset import (
     BrainLargeDataset,
@@ -33,8 +47,12 @@ from scvi.dataset import (
     PurifiedPBMCDataset,
     SyntheticDatasetCorr,
     ZISyntheticDatasetCorr,
+    SparseSyntheticDatasetCorr,
     Dataset10X,
 )
+from scvi.dataset.csv import read_sparse_csv
+from scvi.dataset.dataset import load_datasets
+from scvi.dataset.synthetic import synthetic_corr_params
 from scvi.inference import (
     JointSemiSupervisedTrainer,
     AlternateSemiSupervisedTrainer,
@@ -42,10 +60,23 @@ from scvi.inference import (
     UnsupervisedTrainer,
     AdapterTrainer,
 )
+from scvi.inference.posterior import (
+    BlockShuffleSampler,
+    MultiStreamLoader,
+    NonzeroBalancedBatchSampler,
+    ShardedSampler,
+    StratifiedSampler,
+)
+from scvi.inference.fish import FishPosterior
 from scvi.inference.annotation import compute_accuracy_rf, compute_accuracy_svc
+from scvi.inference.trainer import StateSnapshot
+from scvi.inference.distributed import DistributedUnsupervisedTrainer, launch
+from scvi.inference.hogwild import HogwildTrainer
 from scvi.models import VAE, SCANVI, VAEC
 from scvi.models.classifier import Classifier
+from scvi.models.modules import FCLayers
 import anndata
+import h5py
 import os.path
 
 use_cuda = True
@@ -217,6 +248,14 @@ def test_synthetic_3():
         trainer.model, gene_dataset, trainer.train_set, frequency=1
     )
     adapter_trainer.train(n_path=1, n_epochs=1)
+    # the elbo of the test set is evaluated on the weights of the end of the epoch, up to the noise of the
+    # sampled latent variables
+    assert np.isclose(
+        adapter_trainer.history["elbo_test_set"][-1],
+        trainer.train_set.elbo(),
+        rtol=4e-2,
+    )
+    assert "reconstruction_loss_test_set" not in adapter_trainer.history
 
 
 def test_brain_large(save_path):
@@ -420,3 +459,864 @@ def test_new_10x():
     data = Dataset10X("pbmc_1k_v2")
     data.subsample_genes(new_n_genes=100)
     assert data.X.shape[1] == 100
+
+
+def test_read_sparse_csv(save_path, tmpdir):
+    path = os.path.join(save_path, "GSE100866_CBMC_8K_13AB_10X-RNA_umi.csv.gz")
+    expected = pd.read_csv(path, index_col=0, compression="gzip").T
+    for n_jobs in [1, 2]:
+        data, gene_names = read_sparse_csv(
+            path, compression="gzip", chunksize=3, n_jobs=n_jobs
+        )
+        assert data.dtype == np.float32
+        assert (gene_names == np.array(expected.columns, dtype=str)).all()
+        assert (data.A == expected.values).all()
+
+    # quoted fields holding newlines are kept within their chunk
+    path = str(tmpdir.join("quoted_newlines.csv"))
+    with open(path, "w") as f:
+        f.write('"",c1,c2\n"gene\n1",1,0\ng2,0,2\n"gene ""3""\n",3,0\n')
+    data, gene_names = read_sparse_csv(path, chunksize=1)
+    assert list(gene_names) == ["gene\n1", "g2", 'gene "3"\n']
+    assert (data.A == [[1, 0, 3], [0, 2, 0]]).all()
+
+    breast_cancer_dataset = BreastCancerDataset(save_path=save_path)
+    assert breast_cancer_dataset.dense
+    csv_dataset = CsvDataset(
+        "GSE100866_CBMC_8K_13AB_10X-RNA_umi.csv.gz",
+        save_path=save_path,
+        compression="gzip",
+        dense=False,
+    )
+    assert not csv_dataset.dense
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    payload = bytes(range(256)) * 4096
+    range_requests = []
+    # number of bytes before the requested range at which the served range starts
+    range_shift = 0
+
+    def do_GET(self):
+        start = 0
+        if "Range" in self.headers:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.range_requests.append(start)
+            start -= self.range_shift
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                "bytes %d-%d/%d" % (start, len(self.payload) - 1, len(self.payload)),
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(self.payload) - start))
+        self.end_headers()
+        self.wfile.write(self.payload[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download(tmpdir):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/data" % server.server_port
+    payload = RangeRequestHandler.payload
+    save_path = str(tmpdir)
+    try:
+        # resume an interrupted download
+        with open(os.path.join(save_path, "resumed.bin.part"), "wb") as f:
+            f.write(payload[:1000])
+        GeneExpressionDataset._download(
+            url,
+            save_path,
+            "resumed.bin",
+            checksum="md5:" + hashlib.md5(payload).hexdigest(),
+        )
+        assert RangeRequestHandler.range_requests == [1000]
+        with open(os.path.join(save_path, "resumed.bin"), "rb") as f:
+            assert f.read() == payload
+        assert not os.path.exists(os.path.join(save_path, "resumed.bin.part"))
+
+        # a partial file is not appended another range than the requested one
+        RangeRequestHandler.range_shift = 500
+        with open(os.path.join(save_path, "restarted.bin.part"), "wb") as f:
+            f.write(payload[:1000])
+        GeneExpressionDataset._download(url, save_path, "restarted.bin")
+        RangeRequestHandler.range_shift = 0
+        with open(os.path.join(save_path, "restarted.bin"), "rb") as f:
+            assert f.read() == payload
+
+        # corrupted downloads are not kept
+        with pytest.raises(ValueError):
+            GeneExpressionDataset._download(
+                url, save_path, "corrupted.bin", checksum="0" * 64
+            )
+        assert not os.path.exists(os.path.join(save_path, "corrupted.bin"))
+
+        # several files are fetched concurrently
+        dataset = SimpleNamespace(
+            urls=[url] * 3,
+            download_names=["a.bin", "b.bin", "c.bin"],
+            save_path=os.path.join(save_path, "sub"),
+        )
+        GeneExpressionDataset.download(dataset)
+        for download_name in dataset.download_names:
+            with open(os.path.join(dataset.save_path, download_name), "rb") as f:
+                assert f.read() == payload
+    finally:
+        RangeRequestHandler.range_shift = 0
+        server.shutdown()
+        server.server_close()
+
+
+def test_load_datasets(save_path):
+    purified_pbmc_dataset = PurifiedPBMCDataset(
+        save_path=save_path, filter_cell_types=[0, 1, 7], use_processes=True
+    )
+    assert len(purified_pbmc_dataset.cell_types) == 2
+    constructors = [
+        partial(SyntheticDataset, n_batches=2),
+        partial(SyntheticDataset, n_batches=3),
+    ]
+    datasets = load_datasets(*constructors, n_workers=2)
+    assert [dataset.n_batches for dataset in datasets] == [2, 3]
+    merged = GeneExpressionDataset.concat_datasets(*datasets)
+    assert (merged.X == np.concatenate([dataset.X for dataset in datasets])).all()
+
+
+def test_block_shuffle_sampler():
+    indices = np.random.permutation(1000)[:300]
+    sampler = BlockShuffleSampler(indices, block_size=10, window_size=1)
+    order = np.array(list(sampler))
+    assert len(sampler) == 300
+    assert (np.sort(order) == np.sort(indices)).all()
+    # with a single block per window, each block of 10 draws is one contiguous block of rows
+    sorted_indices = np.sort(indices)
+    for block in order.reshape(-1, 10):
+        start = np.searchsorted(sorted_indices, block.min())
+        assert (np.sort(block) == sorted_indices[start : start + 10]).all()
+
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda
+    )
+    train_indices = trainer.train_set.indices
+    trainer.block_shuffle_posteriors(block_size=16, window_size=4)
+    assert isinstance(trainer.train_set.data_loader.sampler, BlockShuffleSampler)
+    assert (np.sort(trainer.train_set.indices) == np.sort(train_indices)).all()
+    trainer.train(n_epochs=1)
+
+
+def test_nonzero_balanced_batch_sampler():
+    nnz = np.random.randint(1, 100, size=1000)
+    indices = np.random.permutation(1000)[:500]
+    sampler = NonzeroBalancedBatchSampler(indices, nnz, batch_size=32)
+    n_batches = len(sampler)
+    batches = list(sampler)
+    assert len(batches) == n_batches
+    assert (np.sort(np.concatenate(batches)) == np.sort(indices)).all()
+    batch_nnz = np.array([nnz[batch].sum() for batch in batches])
+    assert (batch_nnz[:-1] >= sampler.max_nnz - nnz.max()).all()
+    assert (batch_nnz <= sampler.max_nnz + nnz.max()).all()
+
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda
+    )
+    train_indices = trainer.train_set.indices
+    trainer.nonzero_balance_posteriors()
+    assert (np.sort(trainer.train_set.indices) == np.sort(train_indices)).all()
+    trainer.train(n_epochs=1)
+    sequential = trainer.train_set.sequential()
+    assert len(np.concatenate([t[0] for t in sequential])) == len(train_indices)
+    trainer.train_set.elbo()
+
+
+def test_stratified_sampler():
+    labels = np.random.randint(0, 3, size=1000)
+    batch_indices = np.random.randint(0, 2, size=1000)
+    indices = np.random.permutation(1000)[:600]
+    sampler = StratifiedSampler(indices, labels, batch_indices)
+    order = np.array(list(sampler))
+    assert (np.sort(order) == np.sort(indices)).all()
+    strata = labels[order] * 2 + batch_indices[order]
+    expected = np.bincount(strata, minlength=6) / len(order)
+    for batch in order.reshape(-1, 50):
+        counts = np.bincount(labels[batch] * 2 + batch_indices[batch], minlength=6)
+        assert (np.abs(counts - 50 * expected) <= 2).all()
+
+    synthetic_dataset = SyntheticDataset()
+    svaec = SCANVI(
+        synthetic_dataset.nb_genes,
+        synthetic_dataset.n_batches,
+        synthetic_dataset.n_labels,
+    )
+    trainer = JointSemiSupervisedTrainer(
+        svaec, synthetic_dataset, n_labelled_samples_per_class=10, use_cuda=use_cuda
+    )
+    labelled = synthetic_dataset.labels.ravel()[trainer.labelled_set.indices]
+    assert (np.bincount(labelled) == 10).all()
+    assert (
+        len(
+            np.intersect1d(trainer.labelled_set.indices, trainer.unlabelled_set.indices)
+        )
+        == 0
+    )
+    assert len(trainer.labelled_set.indices) + len(
+        trainer.unlabelled_set.indices
+    ) == len(synthetic_dataset)
+
+
+def test_spatial_index():
+    n_cells = 500
+    x_coord, y_coord = np.random.uniform(0, 100, size=(2, n_cells))
+    synthetic_dataset = SyntheticDataset(batch_size=n_cells, n_batches=1)
+    synthetic_dataset.x_coord, synthetic_dataset.y_coord = x_coord, y_coord
+    grid = synthetic_dataset.spatial_index
+    coords = np.stack([x_coord, y_coord], axis=1)
+
+    in_radius = grid.radius_query(30.0, 40.0, radius=12.5)
+    distances = np.linalg.norm(coords - [30.0, 40.0], axis=1)
+    assert (in_radius == np.flatnonzero(distances <= 12.5)).all()
+    in_region = grid.region_query(10, 20, 50, 90)
+    expected = np.flatnonzero(
+        (x_coord >= 10) & (x_coord <= 20) & (y_coord >= 50) & (y_coord <= 90)
+    )
+    assert (in_region == expected).all()
+
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda
+    )
+    posterior = trainer.create_posterior(
+        indices=trainer.train_set.indices, type_class=FishPosterior
+    )
+    neighbors = posterior.spatial_neighbors(radius=10.0)
+    for idx, close in zip(posterior.indices[:20], neighbors):
+        expected = np.flatnonzero(np.linalg.norm(coords - coords[idx], axis=1) <= 10.0)
+        expected = np.intersect1d(expected, posterior.indices)
+        assert (close == expected[expected != idx]).all()
+
+    blocked = trainer.train_set.spatially_blocked(batch_size=32)
+    batches = list(blocked.data_loader.batch_sampler)
+    assert (np.sort(np.concatenate(batches)) == np.sort(posterior.indices)).all()
+    # batches of nearby cells are spatially much tighter than random ones
+    spread = np.mean([coords[batch].std(axis=0).sum() for batch in batches[:-1]])
+    assert spread < coords.std(axis=0).sum() / 2
+    assert len(next(iter(blocked))) == 7
+
+    synthetic_dataset.update_cells(np.arange(100))
+    assert len(synthetic_dataset.spatial_index) == 100
+
+
+def test_append_cells():
+    for sparse in [False, True]:
+        dataset = SyntheticDataset(batch_size=50, nb_genes=20, n_batches=2)
+        if sparse:
+            dataset.X = sp_sparse.csr_matrix(dataset.X)
+            dataset.dense = False
+        reference = [dataset.X.toarray() if sparse else dataset.X.copy()]
+        batch_indices = [dataset.batch_indices.ravel()]
+        for i in range(4):
+            new_X = np.random.negative_binomial(5, 0.3, size=(30, 25)).astype(
+                np.float32
+            )
+            gene_names = np.random.permutation(
+                np.concatenate([np.arange(20), np.arange(100, 105)]).astype(np.str)
+            )
+            dataset.append_cells(
+                sp_sparse.csr_matrix(new_X) if sparse else new_X,
+                gene_names=gene_names,
+                batch_indices=np.arange(30) % 2 if i % 2 else 0,
+                new_batches=i < 2,
+            )
+            aligned = np.zeros((30, 20), dtype=np.float32)
+            kept = gene_names.astype(np.int64) < 20
+            aligned[:, gene_names[kept].astype(np.int64)] = new_X[:, kept]
+            reference.append(aligned)
+            batch_indices.append(
+                (np.arange(30) % 2 if i % 2 else np.zeros(30)) + [2, 3, 0, 0][i]
+            )
+        X = dataset.X.toarray() if sparse else dataset.X
+        assert (X == np.concatenate(reference)).all()
+        assert (dataset.batch_indices.ravel() == np.concatenate(batch_indices)).all()
+        assert dataset.n_batches == 5
+        # the per-cell arrays grow in place while their buffers have room
+        buffers = [dataset.batch_indices.base, dataset.local_means.base]
+        dataset.append_cells(
+            reference[-1][:5] + 1, batch_indices=np.int64(4), new_batches=False
+        )
+        assert dataset.batch_indices.base is buffers[0]
+        assert dataset.local_means.base is buffers[1]
+        assert (dataset.batch_indices[-5:] == 4).all()
+        local_means, local_vars = dataset.local_means.copy(), dataset.local_vars.copy()
+        dataset.library_size_batch()
+        assert np.allclose(local_means, dataset.local_means, atol=1e-4)
+        assert np.allclose(local_vars, dataset.local_vars, atol=1e-4)
+        posterior = UnsupervisedTrainer(
+            VAE(dataset.nb_genes, dataset.n_batches), dataset
+        ).train_set
+        assert len(next(iter(posterior))[0]) == 128
+
+
+def test_sparse_synthetic_corr(tmpdir):
+    kwargs = dict(
+        n_cells_cluster=2000,
+        n_clusters=3,
+        n_overlap=5,
+        dropout_coef_high=0.05,
+        dropout_coef_low=0.08,
+        chunk_size=700,
+        seed=3,
+    )
+    dataset = SparseSyntheticDatasetCorr(**kwargs)
+    assert sp_sparse.isspmatrix_csr(dataset.X)
+    assert (
+        dataset.X.toarray() == SparseSyntheticDatasetCorr(**kwargs).X.toarray()
+    ).all()
+    path = str(tmpdir.join("synthetic.h5"))
+    stored = SparseSyntheticDatasetCorr(path=path, **kwargs)
+    assert (stored.X != dataset.X).nnz == 0
+    assert (stored.labels == dataset.labels).all()
+
+    exprs_param, is_highly_exp = synthetic_corr_params(n_clusters=3, n_overlap=5)
+    assert dataset.nb_genes == exprs_param.shape[1]
+    expected = exprs_param * (1 - np.where(is_highly_exp, 0.05, 0.08))
+    for cluster in range(3):
+        cells = dataset.labels.ravel() == cluster
+        mean = np.asarray(dataset.X[cells].mean(axis=0)).ravel()
+        assert np.allclose(mean, expected[cluster], atol=0.15)
+
+
+def test_export_to_anndata(tmpdir):
+    synthetic_dataset = SyntheticDataset()
+    svaec = SCANVI(
+        synthetic_dataset.nb_genes,
+        synthetic_dataset.n_batches,
+        synthetic_dataset.n_labels,
+    )
+    trainer = JointSemiSupervisedTrainer(svaec, synthetic_dataset, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    full = trainer.create_posterior()
+    adata = anndata.AnnData(synthetic_dataset.X)
+    # imputation samples z: use the same random stream for both computations
+    torch.manual_seed(0)
+    full.export_to_anndata(
+        adata, imputed_layer="imputed", predictions_key="predictions"
+    )
+    torch.manual_seed(0)
+    latent = full.sequential().get_latent()[0]
+    imputed = full.sequential().imputation()
+    assert np.allclose(adata.obsm["X_scvi"], latent, atol=1e-5)
+    assert np.allclose(adata.layers["imputed"], imputed, atol=1e-5)
+    predictions = full.sequential().compute_predictions()[1]
+    assert (adata.obs["predictions"].values == predictions).all()
+
+    # subsets are written in the rows of their cells, in original order
+    unlabelled = trainer.unlabelled_set
+    out = np.zeros((len(synthetic_dataset), svaec.n_latent), dtype=np.float32)
+    unlabelled.write_latent(out)
+    rows = np.sort(unlabelled.indices)
+    assert np.allclose(out[rows], latent[rows], atol=1e-5)
+    assert (np.delete(out, rows, axis=0) == 0).all()
+
+    with h5py.File(str(tmpdir.join("out.h5")), "w") as f:
+        dataset = f.create_dataset(
+            "latent", (len(synthetic_dataset), svaec.n_latent), dtype=np.float32
+        )
+        unlabelled.write_latent(dataset)
+        assert np.allclose(dataset[...][rows], latent[rows], atol=1e-5)
+
+    class SliceRecorder:
+        slices = []
+
+        def __setitem__(self, key, value):
+            self.slices.append(key)
+
+    # the shuffled cells of the subset are written in a few slices per batch
+    unlabelled.write_latent(SliceRecorder(), batch_size=64)
+    n_runs = 1 + np.sum(np.diff(rows) != 1)
+    assert len(SliceRecorder.slices) <= n_runs + np.ceil(len(rows) / 64)
+
+
+def test_import_time():
+    for module in ["scvi.inference", "scvi.dataset"]:
+        import_time, loaded = import_time_benchmark(module, n_runs=1)
+        assert loaded == []
+        assert import_time > 0
+
+
+def test_mixed_precision():
+    synthetic_dataset = SyntheticDataset()
+    results = mixed_precision_benchmark(synthetic_dataset, n_epochs=2)
+    assert np.isfinite(results["elbo_bfloat16"]) and results["speedup"] > 0
+    assert results["elbo_relative_gap"] < 0.05
+
+    svaec = SCANVI(
+        synthetic_dataset.nb_genes,
+        synthetic_dataset.n_batches,
+        synthetic_dataset.n_labels,
+    )
+    trainer_svaec = JointSemiSupervisedTrainer(
+        svaec, synthetic_dataset, use_cuda=False, mixed_precision=True, frequency=1
+    )
+    trainer_svaec.train(n_epochs=1)
+    assert np.isfinite(trainer_svaec.history["elbo_unlabelled_set"][-1])
+
+
+def test_gradient_accumulation():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae,
+        synthetic_dataset,
+        train_size=0.5,
+        use_cuda=False,
+        data_loader_kwargs={"batch_size": 64},
+        accumulation_steps=3,
+        lr_scaling="linear",
+        lr_warmup_epochs=1,
+    )
+    assert trainer.effective_batch_size == 192
+    trainer.train(n_epochs=2, lr=1e-3)
+    n_batches = len(trainer.train_set.data_loader)
+    param = next(iter(trainer.optimizer.state.values()))
+    assert param["step"] == 2 * np.ceil(n_batches / 3)
+    assert trainer.optimizer.param_groups[0]["lr"] == pytest.approx(1.5e-3)
+
+    svaec = SCANVI(
+        synthetic_dataset.nb_genes,
+        synthetic_dataset.n_batches,
+        synthetic_dataset.n_labels,
+    )
+    trainer_svaec = JointSemiSupervisedTrainer(
+        svaec, synthetic_dataset, use_cuda=False, accumulation_steps=2
+    )
+    trainer_svaec.train(n_epochs=1)
+
+
+def test_checkpoint_resume(tmpdir):
+    synthetic_dataset = SyntheticDataset()
+
+    def make_trainer(**kwargs):
+        vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+        return UnsupervisedTrainer(
+            vae,
+            synthetic_dataset,
+            train_size=0.5,
+            use_cuda=False,
+            frequency=1,
+            early_stopping_kwargs={
+                "early_stopping_metric": "elbo",
+                "reduce_lr_on_plateau": True,
+                "lr_patience": 1,
+            },
+            **kwargs
+        )
+
+    # the metrics computed in the background are recorded before the checkpoints
+    for async_metrics in [False, True]:
+        torch.manual_seed(0)
+        checkpoint_path = str(tmpdir.join("checkpoint_%d_{epoch}.pt" % async_metrics))
+        trainer = make_trainer(
+            checkpoint_path=checkpoint_path,
+            checkpoint_frequency=2,
+            async_metrics=async_metrics,
+        )
+        trainer.train(n_epochs=4)
+        assert os.path.exists(checkpoint_path.format(epoch=3))
+        assert trainer._checkpoint_executor is None
+
+        resumed = make_trainer(async_metrics=async_metrics)
+        resumed.train(n_epochs=4, resume_from=checkpoint_path.format(epoch=1))
+        assert resumed.history["elbo_test_set"] == trainer.history["elbo_test_set"]
+        for param, param_resumed in zip(
+            trainer.model.parameters(), resumed.model.parameters()
+        ):
+            assert torch.equal(param, param_resumed)
+
+
+def test_state_snapshot(tmpdir):
+    vae = VAE(100, 2)
+    snapshot = StateSnapshot(vae, path=str(tmpdir.join("best_state.mmap")))
+    snapshot.update(vae)
+    data_ptrs = [buffer.data_ptr() for buffer in snapshot.state_dict().values()]
+    state_dict = {key: value.clone() for key, value in vae.state_dict().items()}
+    for param in vae.parameters():
+        param.data += 1
+    snapshot_ = snapshot.state_dict()
+    assert [buffer.data_ptr() for buffer in snapshot_.values()] == data_ptrs
+    assert all(torch.equal(snapshot_[key], state_dict[key]) for key in state_dict)
+    vae.load_state_dict(snapshot_)
+    assert all(
+        torch.equal(vae.state_dict()[key], state_dict[key]) for key in state_dict
+    )
+
+    # dtypes that numpy does not support are stored as well
+    vae = VAE(100, 2).to(torch.bfloat16)
+    snapshot = StateSnapshot(vae, path=str(tmpdir.join("best_state_bf16.mmap")))
+    snapshot.update(vae)
+    assert all(
+        value.dtype == snapshot.state_dict()[key].dtype
+        and torch.equal(value, snapshot.state_dict()[key])
+        for key, value in vae.state_dict().items()
+    )
+
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae,
+        synthetic_dataset,
+        use_cuda=False,
+        frequency=1,
+        early_stopping_kwargs={"save_best_state_metric": "elbo", "on": "test_set"},
+    )
+    trainer.train(n_epochs=3)
+    assert all(
+        torch.equal(vae.state_dict()[key], value)
+        and vae.state_dict()[key].data_ptr() != value.data_ptr()
+        for key, value in trainer.best_state_dict.items()
+    )
+
+
+def test_running_elbo():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae, synthetic_dataset, train_size=0.5, use_cuda=False, frequency=1
+    )
+    calls = []
+    elbo = trainer.train_set.elbo
+    trainer.train_set.elbo = lambda: calls.append(1) or elbo()
+    trainer.train(n_epochs=3)
+    # only the metrics before the first epoch need an evaluation pass over the training set
+    assert len(calls) == 1
+    history = trainer.history
+    assert len(history["elbo_train_set"]) == len(history["elbo_test_set"]) == 4
+    assert history["elbo_train_set"][-1] == pytest.approx(
+        history["reconstruction_loss_train_set"][-1]
+        + history["kl_divergence_train_set"][-1]
+    )
+
+
+def test_concurrent_metrics():
+    synthetic_dataset = SyntheticDataset()
+    histories = []
+    n_threads = torch.get_num_threads()
+    for n_eval_workers in [1, 4]:
+        svaec = SCANVI(
+            synthetic_dataset.nb_genes,
+            synthetic_dataset.n_batches,
+            synthetic_dataset.n_labels,
+        )
+        trainer = JointSemiSupervisedTrainer(
+            svaec,
+            synthetic_dataset,
+            use_cuda=False,
+            frequency=1,
+            metrics_to_monitor=["elbo", "accuracy"],
+            n_eval_workers=n_eval_workers,
+        )
+        trainer.train(n_epochs=2)
+        histories.append(trainer.history)
+        assert torch.get_num_threads() == n_threads
+    assert list(histories[0]) == list(histories[1])
+    for key in histories[1]:
+        assert len(histories[0][key]) == len(histories[1][key]) == 3
+        if key.startswith("accuracy"):
+            assert all(0 <= value <= 1 for value in histories[1][key])
+        if key.startswith("elbo"):
+            assert all(value > 1 for value in histories[1][key])
+
+
+def test_async_metrics():
+    synthetic_dataset = SyntheticDataset()
+
+    def train(seed):
+        torch.manual_seed(seed)
+        vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+        trainer = UnsupervisedTrainer(
+            vae,
+            synthetic_dataset,
+            use_cuda=False,
+            frequency=1,
+            async_metrics=True,
+            early_stopping_kwargs={"save_best_state_metric": "elbo", "on": "test_set"},
+        )
+        trainer.train(n_epochs=4)
+        return vae, trainer
+
+    vae, trainer = train(0)
+    # the evaluation does not draw from the random stream of the training
+    other_vae, other_trainer = train(0)
+    assert trainer.history["elbo_test_set"] == other_trainer.history["elbo_test_set"]
+    assert all(
+        torch.equal(other_vae.state_dict()[key], value)
+        for key, value in vae.state_dict().items()
+    )
+    # before training, after each epoch, and after restoring the best state
+    assert len(trainer.history["elbo_test_set"]) == 6
+    best = np.argmin(trainer.history["elbo_test_set"][:-1])
+    assert trainer.best_epoch == best - 1
+    assert all(
+        torch.equal(vae.state_dict()[key], value)
+        for key, value in trainer.best_state_dict.items()
+    )
+
+
+def train_distributed(save_path):
+    np.random.seed(0)
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = DistributedUnsupervisedTrainer(
+        vae,
+        synthetic_dataset,
+        use_cuda=False,
+        frequency=1,
+        early_stopping_kwargs={"save_best_state_metric": "elbo", "on": "test_set"},
+    )
+    trainer.train(n_epochs=3)
+    torch.save(
+        {"model": vae.state_dict(), "history": dict(trainer.history)},
+        os.path.join(save_path, "rank_%d.pt" % trainer.rank),
+    )
+
+
+def test_distributed(tmpdir):
+    shards = [list(ShardedSampler(np.arange(10), 3, rank, seed=1)) for rank in range(3)]
+    assert all(len(shard) == 4 for shard in shards)
+    assert set(np.concatenate(shards)) == set(range(10))
+
+    launch(train_distributed, world_size=2, args=(str(tmpdir),))
+    rank_0, rank_1 = [torch.load(str(tmpdir.join("rank_%d.pt" % r))) for r in [0, 1]]
+    for key, value in rank_0["model"].items():
+        assert torch.equal(value, rank_1["model"][key])
+    assert len(rank_0["history"]["elbo_train_set"]) == 5
+    assert rank_1["history"] == {}
+
+
+def test_hogwild():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = HogwildTrainer(vae, synthetic_dataset, n_workers=2, frequency=1)
+    params = [param.detach().clone() for param in vae.parameters()]
+    # the workers are forked before the main process computes anything
+    compute_metrics, workers_started = trainer.compute_metrics, []
+
+    def record_compute_metrics():
+        workers_started.append(trainer._workers is not None)
+        compute_metrics()
+
+    trainer.compute_metrics = record_compute_metrics
+    trainer.train(n_epochs=3)
+    assert len(workers_started) == 4 and all(workers_started)
+    assert trainer._workers is None
+    # the updates of the workers are visible in the main process
+    assert not all(
+        torch.equal(param, param_) for param, param_ in zip(vae.parameters(), params)
+    )
+    history = trainer.history
+    assert len(history["elbo_train_set"]) == len(history["elbo_test_set"]) == 4
+    assert history["elbo_test_set"][-1] < history["elbo_test_set"][0]
+
+    class DyingHogwildTrainer(HogwildTrainer):
+        def _work(self, rank, *args):
+            if rank == 1:
+                os._exit(1)
+            super()._work(rank, *args)
+
+    trainer = DyingHogwildTrainer(vae, synthetic_dataset, n_workers=2)
+    with pytest.raises(RuntimeError, match="exited with code 1"):
+        trainer.train(n_epochs=1)
+    assert trainer._workers is None
+    with pytest.raises(ValueError):
+        HogwildTrainer(vae, synthetic_dataset, lr_schedule="cosine")
+
+
+def test_compile_model():
+    synthetic_dataset = SyntheticDataset()
+    histories = []
+    for compile_model in [False, True]:
+        torch.manual_seed(0)
+        vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+        trainer = UnsupervisedTrainer(
+            vae,
+            synthetic_dataset,
+            use_cuda=False,
+            frequency=1,
+            compile_model=compile_model,
+        )
+        trainer.train(n_epochs=2)
+        histories.append(trainer.history["elbo_test_set"])
+    assert np.allclose(histories[0], histories[1], rtol=1e-4)
+
+    # the fast forward pass of FCLayers on 2D inputs matches the one on 3D inputs
+    layers = FCLayers(10, 5, n_cat_list=[3], dropout_rate=0).eval()
+    x, cat = torch.randn(2, 4, 10), torch.randint(0, 3, (4, 1))
+    assert torch.allclose(layers(x, cat)[1], layers(x[1], cat), atol=1e-6)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch.nn.Module, "compile"), reason="requires torch.nn.Module.compile"
+)
+def test_compile_model_in_place():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    keys = list(vae.state_dict())
+    trainer = UnsupervisedTrainer(
+        vae,
+        synthetic_dataset,
+        use_cuda=False,
+        frequency=1,
+        compile_model=True,
+        async_metrics=True,
+    )
+    trainer.train(n_epochs=2)
+    # the model is compiled in place and keeps its parameters, but not its copy evaluating the metrics
+    assert trainer.model is vae and list(vae.state_dict()) == keys
+    assert vae._compiled_call_impl is not None
+    assert trainer._shadow_model._compiled_call_impl is None
+    assert np.isfinite(trainer.history["elbo_test_set"]).all()
+
+
+def test_profile(tmpdir):
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trace_path = os.path.join(str(tmpdir), "trace_{epoch}.json")
+    trainer = UnsupervisedTrainer(
+        vae,
+        synthetic_dataset,
+        use_cuda=False,
+        frequency=1,
+        profile=True,
+        trace_epochs=[1],
+        trace_path=trace_path,
+    )
+    entered = []
+
+    @contextlib.contextmanager
+    def record(name):
+        entered.append(name)
+        yield
+
+    trainer.add_phase_hook(record)
+    trainer.train(n_epochs=2)
+    n_batches = len(trainer.train_set.data_loader)
+    assert entered.count("forward") == entered.count("step") == 2 * n_batches
+    assert entered.count("metrics") == 2
+    for key in ["time_data", "time_forward", "time_backward", "time_step"]:
+        assert len(trainer.history[key]) == 2 and min(trainer.history[key]) > 0
+    assert trainer.history["cells_per_second"][0] > 0
+    assert trainer.history["peak_rss_mb"][0] > 0
+    assert os.path.exists(trace_path.format(epoch=1))
+    assert not os.path.exists(trace_path.format(epoch=0))
+
+
+def test_training_budgets():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(
+        vae, synthetic_dataset, use_cuda=False, frequency=1, lr_schedule="one_cycle"
+    )
+    lrs, losses, lr = trainer.lr_range_test(n_iter=20)
+    assert len(lrs) == len(losses) and lrs[0] == 1e-6 and lrs[0] < lr < lrs[-1]
+    trainer.train(
+        n_epochs=10, lr=lr, target_metric="reconstruction_error", target_value=np.inf
+    )
+    assert trainer.stop_reason == "target" and trainer.epoch == 0
+    # the target metric is only monitored during the call which set it, even if it fails
+    assert trainer.metrics_to_monitor == {"elbo"}
+    assert len(trainer.history["reconstruction_error_test_set"]) == 2
+    with pytest.raises(FileNotFoundError):
+        trainer.train(
+            resume_from="missing.pt",
+            target_metric="reconstruction_error",
+            target_value=np.inf,
+        )
+    assert trainer.metrics_to_monitor == {"elbo"}
+    trainer.train(n_epochs=10, max_time=0)
+    assert trainer.stop_reason == "max_time" and trainer.epoch == 0
+    trainer.train(n_epochs=2)
+    assert trainer.stop_reason == "n_epochs"
+
+    trainer.lr_schedule = "cosine"
+    trainer.n_iter, trainer.n_iter_total = 0, 100
+    assert trainer.scheduled_lr(1.0, n_iter_warmup=10) == 0.1
+    trainer.n_iter = 55
+    assert np.isclose(trainer.scheduled_lr(1.0, n_iter_warmup=10), 0.5)
+    trainer.lr_schedule = "one_cycle"
+    trainer.n_iter = 0
+    assert np.isclose(trainer.scheduled_lr(1.0), 1 / 25)
+    trainer.n_iter = 30
+    assert np.isclose(trainer.scheduled_lr(1.0), 1.0)
+
+    # no learning rate to suggest when the loss is not finite from the start
+    with torch.no_grad():
+        next(vae.parameters()).fill_(np.nan)
+    with pytest.raises(ValueError, match="not finite"):
+        trainer.lr_range_test(n_iter=5)
+
+    results = fast_training_benchmark(synthetic_dataset, n_epochs=2)
+    assert results["stop_reason"] in ["target", "n_epochs"]
+
+
+def test_multi_stream_loader():
+    # the first gene of each cell holds its index
+    X = np.arange(1, 101)[:, None] * np.ones((1, 5))
+    dataset = GeneExpressionDataset(
+        *GeneExpressionDataset.get_attributes_from_matrix(X)
+    )
+    vae = VAE(dataset.nb_genes, dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, dataset, use_cuda=False)
+    main = trainer.create_posterior(indices=np.arange(60))
+    labelled = trainer.create_posterior(indices=np.arange(60, 100))
+
+    def cells(tensors):
+        return tensors[0][:, 0].int().tolist()
+
+    loader = MultiStreamLoader(
+        [main, labelled], ratios=[2, 1], batch_sizes=[10, 8], n_prefetch=2
+    )
+    steps = list(loader)
+    assert len(steps) == len(loader) == 6
+    assert sorted(sum((cells(step[0]) for step in steps), [])) == list(range(1, 61))
+    # a new minibatch of the second stream every two steps, from an iterator re-created when exhausted
+    assert all(step[1] is steps[2 * (i // 2)][1] for i, step in enumerate(steps))
+    assert all(len(step[1][0]) == 8 for step in steps)
+
+    # three minibatches of the second stream, each holding all its cells, concatenated in one step
+    steps = list(MultiStreamLoader([main, labelled], ratios=[1, 3]))
+    drawn = sum((cells(step[1]) for step in steps), [])
+    assert len(steps) == 1 and sorted(drawn) == sorted(3 * list(range(61, 101)))
+
+    # leaving the loop early stops the prefetching thread
+    n_threads = threading.active_count()
+    for _ in MultiStreamLoader([main, labelled], n_prefetch=1):
+        break
+    assert threading.active_count() == n_threads
+
+    # the prefetching thread leaves the random stream of the training untouched
+    synthetic_dataset = SyntheticDataset()
+    states = []
+    for _ in range(2):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        svaec = SCANVI(
+            synthetic_dataset.nb_genes,
+            synthetic_dataset.n_batches,
+            synthetic_dataset.n_labels,
+        )
+        trainer = JointSemiSupervisedTrainer(
+            svaec, synthetic_dataset, use_cuda=False, stream_ratios=[1, 4], n_prefetch=2
+        )
+        trainer.train(n_epochs=3)
+        states.append(svaec.state_dict())
+    assert all(torch.equal(states[1][key], value) for key, value in states[0].items())
+
+    # the batch sampler of a posterior would ignore the batch size
+    with pytest.raises(ValueError):
+        MultiStreamLoader([main, labelled.nonzero_balanced()], batch_sizes=[10, 8])